@@ -1,38 +1,294 @@
+import asyncio
 import glob
+import hashlib
 import json
 import logging
+import mmap
+import multiprocessing
+import queue
 import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import threading
 import time
+from array import array
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 
 logger = logging.getLogger(__name__)
 
 import os
 from datetime import datetime, timedelta
 
-from internetarchive import get_item, download, get_session, configure, File
-from ffmpeg import FFmpeg
-
 from pathlib import Path
 
-from tabulate import tabulate
-
 from more_itertools import chunked
-
-
-def chunk_write_md_file(md_path, i, header: str, body_lines: list, max_bytes=345 * 1000):
-    bytes_written = 0
-    with open(md_path.with_stem(f"{md_path.stem}_{i}"), 'wb') as f:
-        bytes_written += f.write(header.encode('utf-8'))
-        for l, line in enumerate(body_lines):
-            line = line+'\n'
-            bytes_written += f.write(line.encode('utf-8'))
+from urllib.parse import quote
+
+# internetarchive, ffmpeg, faster_whisper, numpy, requests and tabulate are imported where they are used, so that
+# commands like status don't pay for them and the model is only loaded when something needs transcribing
+
+
+try:
+    import wcwidth
+except ImportError:
+    wcwidth = None
+
+
+def chunk_write_md_file(md_path, i, header: str, body_lines, max_bytes=345 * 1000):
+    """
+    Writes the header and then body lines to <md_path stem>_<i>.md, rolling over to _<i+1>.md and so on once a file
+    reaches max_bytes. Every chunk starts with the header and each file is written exactly once.
+    """
+    header = header.encode('utf-8')
+    chunk_paths = []
+    f = None
+    try:
+        for line in body_lines:
+            if f is None:
+                chunk_path = md_path.with_stem(f"{md_path.stem}_{i + len(chunk_paths)}")
+                chunk_paths.append(str(chunk_path))
+                f = open(chunk_path, 'wb')
+                bytes_written = f.write(header)
+            bytes_written += f.write((line + '\n').encode('utf-8'))
             if bytes_written >= max_bytes:
-                break
-    if l < len(body_lines) - 1:
-        chunk_write_md_file(md_path, i + 1, header, body_lines[l+1:], max_bytes)
+                f.close()
+                f = None
+    finally:
+        if f is not None:
+            f.close()
+    if not chunk_paths:
+        chunk_path = md_path.with_stem(f"{md_path.stem}_{i}")
+        chunk_path.write_bytes(header)
+        chunk_paths.append(str(chunk_path))
+    return chunk_paths
+
+
+MD_TABLE_HEADERS = ['Time', 'Transcript', 'Video']
+# line breaks, ANSI escapes and other control characters get special treatment from tabulate
+_TABULATE_ONLY_CHARACTERS = re.compile('[\x00-\x1f\x7f\x85\u2028\u2029]')
+_MD_TABLE_WHITESPACE = re.compile(r' *(?=\|)')
+
+
+def _cell_width(cell):
+    if cell.isascii() or wcwidth is None:
+        return len(cell)
+    return wcwidth.wcswidth(cell)
+
+
+def _is_text(cell):
+    # whether tabulate would treat the cell as a string rather than a number, bool or missing value
+    if not cell or cell.lower() in ('true', 'false'):
+        return False
+    for convert in (int, float):
+        try:
+            convert(cell.replace(',', ''))
+            return False
+        except ValueError:
+            pass
+    return True
+
+
+def markdown_table_lines(header_lines, rows, headers=MD_TABLE_HEADERS):
+    """
+    Renders header lines followed by a github pipe table of rows in one linear pass, producing the same lines as
+    tabulate(tablefmt='github') followed by SearchableVideo.remove_md_table_whitespace. Returns (header lines, body
+    lines), or None when a cell needs tabulate's handling of numeric columns, line breaks or control characters.
+    """
+    if any(_TABULATE_ONLY_CHARACTERS.search(line) for line in header_lines):
+        return None
+    # tabulate pads headers by at least 2
+    widths = [len(header) + 2 for header in headers]
+    has_text = [False] * len(headers)
+    body_lines = []
+    for row in rows:
+        cells = [cell.strip() for cell in row]
+        for i, cell in enumerate(cells):
+            if _TABULATE_ONLY_CHARACTERS.search(cell):
+                return None
+            widths[i] = max(widths[i], _cell_width(cell))
+            has_text[i] = has_text[i] or _is_text(cell)
+        line = '| ' + '| '.join(cells) + '|'
+        body_lines.append(_MD_TABLE_WHITESPACE.sub('', line) if ' |' in line else line)
+    if body_lines and not all(has_text):
+        return None
+    table_header_lines = ['| ' + '| '.join(headers) + '|',
+                          '|' + '|'.join('-' * (width + 2) for width in widths) + '|']
+    return [_MD_TABLE_WHITESPACE.sub('', line) for line in header_lines] + table_header_lines, body_lines
+
+
+def file_md5(path, chunk_size=1024 * 1024):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+@contextmanager
+def atomic_open(path, mode='w'):
+    """
+    Opens a temporary file next to path that is renamed over path once the block exits cleanly, so a reader never sees
+    a half written file and a crash leaves the previous version in place.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # per thread, so threads writing the same path don't share a temporary file
+    tmp_path = path.with_name(f'{path.name}.{threading.get_ident()}.tmp')
+    try:
+        with open(tmp_path, mode) as fp:
+            yield fp
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def write_json_atomic(path, obj, **dump_options):
+    with atomic_open(path) as fp:
+        json.dump(obj, fp, **dump_options)
+    return Path(path)
+
+
+class RunManifest:
+    """
+    Append-only JSON Lines log of per-identifier progress for one video series. Each line records a completed stage
+    with its output files, their sizes and, except for media, their md5s, or the item metadata under the 'metadata'
+    stage. Later lines win, so reading the log once tells us what work remains without touching IA or the data
+    directories.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.records = {}
+        self._lock = threading.Lock()
+        self._terminate_partial_line = False
+        if self.path.exists():
+            with open(self.path, 'r') as fp:
+                for line in fp:
+                    self._terminate_partial_line = not line.endswith('\n')
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a run killed mid-write can leave a partial last line
+                        logger.warning(f"Skipping unreadable manifest line in {self.path}")
+                        continue
+                    self.records.setdefault(record['identifier'], {})[record['stage']] = record
+
+    def record(self, identifier, stage, **fields):
+        record = {'identifier': identifier, 'stage': stage, 'recorded_at': time.time(), **fields}
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, 'a') as fp:
+                if self._terminate_partial_line:
+                    fp.write('\n')
+                    self._terminate_partial_line = False
+                fp.write(json.dumps(record) + '\n')
+            self.records.setdefault(identifier, {})[stage] = record
+        return record
+
+    def record_files(self, identifier, stage, paths, hash_files=True, **fields):
+        files = [{'path': str(path), 'size': Path(path).stat().st_size} for path in paths]
+        if hash_files:
+            for file in files:
+                file['md5'] = file_md5(file['path'])
+        return self.record(identifier, stage, files=files, **fields)
+
+    def get(self, identifier, stage):
+        return self.records.get(identifier, {}).get(stage)
+
+    def stage_complete(self, identifier, stage):
+        return stage in self.records.get(identifier, {})
+
+    def identifiers(self):
+        return list(self.records)
+
+
+def iter_segments(segment_file):
+    """Lazily yields segment dicts from a segment file without loading the whole array."""
+    with open(segment_file, 'r') as fp:
+        first_line = fp.readline()
+        if first_line.strip() != '[':
+            # segment files written before SegmentWriter hold the whole array on a single line
+            yield from json.loads(first_line + fp.read())
+            return
+        for line in fp:
+            line = line.strip().rstrip(',')
+            if line and line != ']':
+                yield json.loads(line)
+
+
+class SegmentWriter:
+    """
+    Streams segments to <segment_file>.partial as JSON Lines while transcription runs. Every fsync_every segments the
+    partial file is fsynced and <segment_file>.checkpoint records how many segments and which timestamp are safely on
+    disk. Opening a writer over an interrupted transcription keeps the checkpointed segments and sets offset to
+    where transcription should resume. On success the segments are written to segment_file as a JSON array with one
+    segment per line, which iter_segments can read back lazily.
+    """
+    def __init__(self, segment_file, fsync_every=20, resume=True):
+        self.segment_file = Path(segment_file)
+        self.partial_file = self.segment_file.with_name(self.segment_file.name + '.partial')
+        self.checkpoint_file = self.segment_file.with_name(self.segment_file.name + '.checkpoint')
+        self.fsync_every = fsync_every
+        self.offset = 0.0
+        self.segments_written = 0
+        if resume and self.partial_file.exists() and self.checkpoint_file.exists():
+            with open(self.checkpoint_file, 'r') as fp:
+                checkpoint = json.load(fp)
+            self.offset = checkpoint['end']
+            self.segments_written = checkpoint['segments']
+            self._truncate_partial()
+        else:
+            self.partial_file.unlink(missing_ok=True)
+        self._last_end = self.offset
+        self._fp = open(self.partial_file, 'a')
+
+    def _truncate_partial(self):
+        # anything written after the last checkpoint may be incomplete, so it is transcribed again
+        with open(self.partial_file, 'rb+') as fp:
+            for _ in range(self.segments_written):
+                fp.readline()
+            fp.truncate(fp.tell())
+
+    def write(self, segment: dict):
+        self._fp.write(json.dumps(segment) + '\n')
+        self.segments_written += 1
+        self._last_end = segment['end']
+        if self.segments_written % self.fsync_every == 0:
+            self.checkpoint()
+
+    def checkpoint(self):
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        write_json_atomic(self.checkpoint_file, {'end': self._last_end, 'segments': self.segments_written})
+
+    def finish(self):
+        self._fp.close()
+        with open(self.partial_file, 'r') as partial_fp, atomic_open(self.segment_file) as fp:
+            fp.write('[\n')
+            for i, line in enumerate(partial_fp):
+                fp.write((',\n' if i else '') + line.rstrip('\n'))
+            fp.write('\n]\n')
+        self.partial_file.unlink()
+        self.checkpoint_file.unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.finish()
+        else:
+            # every line written so far is complete, so keep it for the next attempt to resume from
+            self.checkpoint()
+            self._fp.close()
 
 
 class TextSegment:
+    __slots__ = ('start', 'end', 'text', 'url_with_timestamp')
+
     def __init__(self, start, end, text, url_with_timestamp):
         self.start = start
         self.end = end
@@ -68,15 +324,28 @@ class TextSegment:
 
 
 class SearchableVideo:
-    def __init__(self, identifier, video_series): #, url=None, title=None, date=None, video_file=None, audio_file=None):
+    # pipeline stages in order. A stage only has to run if neither it nor any later stage has output on disk.
+    STAGES = ('video', 'audio', 'segment', 'markdown')
+    # media files with these suffixes are downloaded straight to the audio stage
+    AUDIO_SUFFIXES = ('.mp3', '.ogg', '.m4a', '.flac', '.wav')
+
+    def __init__(self, identifier, video_series, url=None, title=None, date=None, video_file_name=None):
+        # metadata that is neither in the manifest nor passed in is fetched from IA
         self.identifier = identifier
         self.video_series = video_series
-        self._url = None
-        self._title = None
-        self._date = None
-        self._full_text = None
+        self._url = url
+        self._title = title
+        self._date = date
         self._segment_file = None
-        self._video_file_name = None
+        self._video_file_name = video_file_name
+        # seconds the last transcription spent decoding its source, fingerprint included, apart from the model
+        self.decode_seconds = 0.0
+
+        metadata = self.video_series.manifest.get(identifier, 'metadata')
+        if metadata:
+            self._url, self._title, self._date = metadata['url'], metadata['title'], metadata['date']
+            self._video_file_name = metadata['video_file_name']
+        self.video_series.make_dirs()
 
         self.file_identifier = self.__getattribute__(self.video_series.file_identifier)
 
@@ -87,6 +356,13 @@ class SearchableVideo:
         video_suffix = Path(self.video_file_name).suffix
         #have to convert paths back to strings because av doesn't handle Path objects
         self._video_file = str(Path(self.video_series.video_dir).joinpath(self.file_identifier).with_suffix(video_suffix))
+        self.audio_only = video_suffix.lower() in self.AUDIO_SUFFIXES
+        if self.audio_only:
+            self._audio_file = str(Path(self.video_series.audio_dir).joinpath(self.file_identifier).with_suffix(video_suffix))
+
+        if not metadata:
+            self.video_series.manifest.record(identifier, 'metadata', url=self.url, title=self.title,
+                                              date=self.date, video_file_name=self.video_file_name)
 
     # def get_video_file_name(self):
     #     self._video_file_name = self.video_series.video_fetcher.get_video_file_name(self.identifier)
@@ -94,41 +370,80 @@ class SearchableVideo:
 
 
     @classmethod
-    def from_json(cls, json):
-        video = cls(json['identifier'], json['url'], json['title'], json['date'])
-        video.full_text = json['full_text']
-        video.segments = [TextSegment.from_json(segment) for segment in json['segments']]
-        video.video_file = json['video_file']
-        video.audio_file = json['audio_file']
+    def from_json(cls, json, video_series):
+        """Restores a video from to_dict output without asking IA for anything."""
+        video = cls(json['identifier'], video_series, url=json['url'], title=json['title'], date=json['date'],
+                    video_file_name=json['video_file_name'])
+        for name in ('video_file', 'audio_file', 'segment_file', 'markdown_file'):
+            if json.get(name):
+                setattr(video, f'_{name}', json[name])
         return video
 
     @property
     def segment_file(self):
         if not Path(self._segment_file).exists():
             logger.info(f"Segments for {self.identifier} do not exist.")
-            logger.info(f"Transcribing {self.identifier} from {self.audio_file} to segments.")
-            segments, info = self.video_series.transcriber.transcribe(self.audio_file)
-            text_segments = [
-                TextSegment(int(segment.start), segment.end, segment.text, self.create_url_with_timestamp(int(segment.start)))
-                for segment in segments]
-            with open(self._segment_file, 'w') as fp:
-                json.dump([segment.to_dict() for segment in text_segments], fp)
+            if self.streams_audio:
+                source, extract_audio = self.video_file, True
+            else:
+                source, extract_audio = self.audio_file, False
+            transcript_cache = self.video_series.transcript_cache
+            cache_key, self.decode_seconds = None, 0.0
+            if transcript_cache is not None:
+                start = time.monotonic()
+                cache_key = transcript_cache.key(source)
+                self.decode_seconds = time.monotonic() - start
+            cached = transcript_cache.get(cache_key) if transcript_cache is not None else None
+            if cached is not None:
+                logger.info(f"Copying the cached transcript of identical audio to {self.identifier}.")
+                with SegmentWriter(self._segment_file, resume=False) as writer:
+                    for segment in cached['segments']:
+                        writer.write(TextSegment(segment['start'], segment['end'], segment['text'],
+                                                 self.create_url_with_timestamp(segment['start'])).to_dict())
+                duration = cached['duration']
+            else:
+                with SegmentWriter(self._segment_file) as writer:
+                    if writer.offset:
+                        logger.info(f"Resuming transcription of {self.identifier} from {writer.offset:.0f}s.")
+                    logger.info(f"Transcribing {self.identifier} from {source} to segments.")
+                    segments, info = self.video_series.transcriber.transcribe(source, offset=writer.offset,
+                                                                              extract_audio=extract_audio)
+                    for segment in segments:
+                        writer.write(TextSegment(int(segment.start), segment.end, segment.text,
+                                                 self.create_url_with_timestamp(int(segment.start))).to_dict())
+                    duration = writer.offset + info.duration
+                    self.decode_seconds += getattr(info, 'decode_seconds', 0.0)
+                if transcript_cache is not None:
+                    transcript_cache.put(cache_key, iter_segments(self._segment_file), duration=duration)
+            # the media duration is kept with the segments for realtime factors in the run report
+            self.record_stage('segment', [self._segment_file], duration=duration)
 
         return self._segment_file
 
+    @property
+    def streams_audio(self):
+        # without an audio file to reuse, audio is piped from the video straight into the transcriber
+        return not (self.video_series.keep_audio or self.audio_only or self.stage_complete('audio'))
+
     def create_url_with_timestamp(self, timestamp):
         return f"{self.url}?start={timestamp}"
 
     @property
     def full_text(self):
-        return ''.join(self.segments)
+        return ''.join(segment['text'] for segment in iter_segments(self.segment_file))
 
     @property
     def audio_file(self):
         if not Path(self._audio_file).exists():
             logger.info(f"Audio file {self._audio_file} does not exist.")
-            logger.info(f"Converting {self.video_file} to audio for {self.identifier}")
-            self._audio_file = video2audio(self.video_file, self._audio_file)
+            if self.audio_only:
+                logger.info(f"Downloading {self.identifier} audio to {self._audio_file}")
+                self._audio_file = self.video_series.video_fetcher.download_video_file(
+                    self.identifier, self._video_file_name, self._audio_file)
+            else:
+                logger.info(f"Converting {self.video_file} to audio for {self.identifier}")
+                self._audio_file = video2audio(self.video_file, self._audio_file)
+            self.record_stage('audio', [self._audio_file])
         return self._audio_file
 
     @property
@@ -138,6 +453,7 @@ class SearchableVideo:
             logger.info(f"Downloading {self.identifier} video to {self._video_file}")
             self._video_file = self.video_series.video_fetcher.download_video_file(
                 self.identifier, self._video_file_name, self._video_file)
+            self.record_stage('video', [self._video_file])
         return self._video_file
 
     def _update_metadata(self):
@@ -173,27 +489,48 @@ class SearchableVideo:
         return self._date
 
     def to_dict(self):
+        # file paths only, reading the video_file or audio_file properties would download or convert them
         return {
             'identifier': self.identifier,
             'url': self.url,
             'title': self.title,
             'date': self.date,
-            'full_text': self.full_text,
-            'segments': [segment.to_dict() for segment in self.segments],
-            'video_file': self.video_file,
-            'audio_file': self.audio_file
+            'video_file_name': self.video_file_name,
+            'video_file': self._video_file,
+            'audio_file': self._audio_file,
+            'segment_file': self._segment_file,
+            'markdown_file': self._markdown_file,
         }
 
     @property
     def markdown_file(self):
-        #TODO: gotta be a cleaner way to do this.
-        glob_pattern = str(Path(self._markdown_file).parent)+'/'+str(Path(self._markdown_file).stem)+'*.md'
-        chunked_files_found = glob.glob(glob_pattern)
-        if not chunked_files_found:
+        if not self.stage_complete('markdown'):
             logger.info(f"Markdown file {self._markdown_file} does not exist.")
             _ = self._write_markdown_file()
         return self._markdown_file
 
+    def record_stage(self, stage, paths, **fields):
+        # downloads were already checked against IA's md5, and reading multi GB media again only to hash it is wasted
+        self.video_series.manifest.record_files(self.identifier, stage, paths,
+                                                hash_files=stage not in ('video', 'audio'), **fields)
+
+    def stage_complete(self, stage):
+        if self.video_series.manifest.stage_complete(self.identifier, stage):
+            return True
+        # outputs written before the manifest existed are picked up from disk once and recorded
+        if stage == 'markdown':
+            glob_pattern = str(Path(self._markdown_file).parent)+'/'+str(Path(self._markdown_file).stem)+'*.md'
+            paths = glob.glob(glob_pattern)
+        else:
+            paths = [path for path in [getattr(self, f'_{stage}_file')] if Path(path).exists()]
+        if paths:
+            self.record_stage(stage, paths)
+        return bool(paths)
+
+    def stage_needed(self, stage):
+        return not any(self.stage_complete(later_stage)
+                       for later_stage in self.STAGES[self.STAGES.index(stage):])
+
     @staticmethod
     def prettify_segment(segment:dict):
         #TODO: Clean this and _write_markdown_file up. Shouldn't have headers defined in two spots and ordering should be explicit
@@ -205,26 +542,32 @@ class SearchableVideo:
 
     @staticmethod
     def remove_md_table_whitespace(md):
-        return re.sub(' *(?=\|)', '', md)
+        return _MD_TABLE_WHITESPACE.sub('', md)
 
 
 
     def _write_markdown_file(self):
         logger.info(f"Writing {self.identifier} markdown to {self._markdown_file}")
-        with open(self.segment_file, 'r') as fp:
-            segments_list = json.load(fp)
+        segments_list = iter_segments(self.segment_file)
         # only write 1300 segments at a time so that github can still index for search
         md_path = Path(self._markdown_file)
         values_list = [self.prettify_segment(segment) for segment in segments_list]
-        segments_md = tabulate(values_list, tablefmt='github', headers=['Time', 'Transcript', 'Video'])
-        md = ''.join([f"## [{self.title}]({self.url})\n",
-                      f"### {self.date}\n",
-                      segments_md])
-        md = self.remove_md_table_whitespace(md)
-        md_lines = md.splitlines()
-        md_header = '\n'.join(md_lines[0:4])+ '\n'
-        md_body_lines = md_lines[4:]
-        chunk_write_md_file(md_path, 0, md_header, md_body_lines)
+        md_table = markdown_table_lines([f"## [{self.title}]({self.url})", f"### {self.date}"], values_list)
+        if md_table:
+            md_header_lines, md_body_lines = md_table
+            md_header = '\n'.join(md_header_lines) + '\n'
+        else:
+            from tabulate import tabulate
+            segments_md = tabulate(values_list, tablefmt='github', headers=MD_TABLE_HEADERS)
+            md = ''.join([f"## [{self.title}]({self.url})\n",
+                          f"### {self.date}\n",
+                          segments_md])
+            md = self.remove_md_table_whitespace(md)
+            md_lines = md.splitlines()
+            md_header = '\n'.join(md_lines[0:4])+ '\n'
+            md_body_lines = md_lines[4:]
+        chunk_paths = chunk_write_md_file(md_path, 0, md_header, md_body_lines)
+        self.record_stage('markdown', chunk_paths)
 
         #
         # for i, chunk in enumerate(chunked(segments_list, n=2000)):
@@ -248,64 +591,732 @@ class SearchableVideo:
 
 class VideoSeries:
     def __init__(self, name, ia_seach_query, video_dir='video', audio_dir='audio',
-                 segment_dir='segment', markdown_dir='markdown', data_dir='data',
-                 file_identifier='title',
-                 video_fetcher=None, transcriber=None):
+                 segment_dir='segment', markdown_dir='markdown', manifest_dir='manifest', columnar_dir='columnar',
+                 data_dir='data',
+                 file_identifier='title', keep_audio=False,
+                 video_fetcher=None, transcriber=None, transcript_cache=None, metrics=None):
         self.name = name
         self.ia_seach_query = ia_seach_query
         self.videos = {}
         self.video_fetcher = video_fetcher
         self.transcriber = transcriber
+        self.transcript_cache = transcript_cache
+        self.metrics = metrics
         self.data_dir = data_dir
         self.video_dir = Path(data_dir).joinpath(video_dir).joinpath(name)
         self.audio_dir = Path(data_dir).joinpath(audio_dir).joinpath(name)
         self.segment_dir = Path(data_dir).joinpath(segment_dir).joinpath(name)
         self.markdown_dir = Path(data_dir).joinpath(markdown_dir).joinpath(name)
+        self.columnar_dir = Path(data_dir).joinpath(columnar_dir).joinpath(name)
         self.file_identifier = file_identifier
+        self.keep_audio = keep_audio
+        self.manifest = RunManifest(Path(data_dir).joinpath(manifest_dir).joinpath(f'{name}.jsonl'))
+        self._dirs_made = False
 
-        Path(self.video_dir).mkdir(parents=True, exist_ok=True)
-        Path(self.audio_dir).mkdir(parents=True, exist_ok=True)
-        Path(self.segment_dir).mkdir(parents=True, exist_ok=True)
-        Path(self.markdown_dir).mkdir(parents=True, exist_ok=True)
+    def make_dirs(self):
+        # left until the series has a video, so loading config or reporting status doesn't touch the data directory
+        if not self._dirs_made:
+            for directory in (self.video_dir, self.audio_dir, self.segment_dir, self.markdown_dir):
+                Path(directory).mkdir(parents=True, exist_ok=True)
+            self._dirs_made = True
 
     @classmethod
-    def from_config(cls, config, video_fetcher=None, transcriber=None):
-        return cls(name=config['name'], ia_seach_query=config['ia_search_query'],
-                   video_fetcher=video_fetcher, transcriber=transcriber)
+    def from_config(cls, config, video_fetcher=None, transcriber=None, keep_audio=False, transcript_cache=None,
+                    metrics=None):
+        return cls(name=config['name'], ia_seach_query=config['ia_search_query'], keep_audio=keep_audio,
+                   video_fetcher=video_fetcher, transcriber=transcriber, transcript_cache=transcript_cache,
+                   metrics=metrics)
 
     @classmethod
-    def from_json(cls, json, video_fetcher=None, transcriber=None):
-        video_series = cls(json['name'], json['ia_seach_query'])
-        video_series.videos = [SearchableVideo.from_json(video_json) for video_json in json['videos']]
-        video_series.video_fetcher = video_fetcher
-        video_series.transcriber = transcriber
+    def from_json(cls, json, video_fetcher=None, transcriber=None, **kwargs):
+        video_series = cls(json['name'], json['ia_seach_query'], data_dir=json.get('data_dir', 'data'),
+                           file_identifier=json.get('file_identifier', 'title'),
+                           keep_audio=json.get('keep_audio', False), video_fetcher=video_fetcher,
+                           transcriber=transcriber, **kwargs)
+        for video_json in json['videos']:
+            video_series.videos[video_json['identifier']] = SearchableVideo.from_json(video_json, video_series)
         return video_series
 
-    def update_identifiers(self):
-        indentifiers = self.video_fetcher.get_video_series_identifiers(self)
-        for identifier in indentifiers:
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'ia_seach_query': self.ia_seach_query,
+            'data_dir': str(self.data_dir),
+            'file_identifier': self.file_identifier,
+            'keep_audio': self.keep_audio,
+            'videos': [video.to_dict() for video in self.videos.values()],
+        }
+
+    def status(self):
+        """Counts of videos per completed stage, read from the manifest alone."""
+        counts = {'videos': 0, **{stage: 0 for stage in SearchableVideo.STAGES}}
+        for identifier in self.manifest.identifiers():
+            if not self.manifest.get(identifier, 'metadata'):
+                continue
+            counts['videos'] += 1
+            for stage in SearchableVideo.STAGES:
+                counts[stage] += self.manifest.stage_complete(identifier, stage)
+        counts['pending'] = counts['videos'] - counts['markdown']
+        return counts
+
+    def update_identifiers(self, identifiers=None):
+        # identifiers seen in earlier runs come from the manifest, so incremental discovery only has to return new ones
+        if identifiers is None:
+            identifiers = self.video_fetcher.get_video_series_identifiers(self)
+        known_identifiers = {identifier: None for identifier in self.manifest.identifiers()
+                             if self.manifest.get(identifier, 'metadata')}
+        for identifier in list(known_identifiers) + list(identifiers):
             if identifier not in self.videos:
+                start = time.monotonic()
                 self.videos[identifier] = SearchableVideo(identifier, self)
+                if self.metrics is not None and identifier not in known_identifiers:
+                    # only videos new to the manifest fetch their metadata while being constructed
+                    self.metrics.record('metadata', time.monotonic() - start, series=self.name, identifier=identifier)
+
+    def pending_videos(self):
+        return [video for video in self.videos.values()
+                if not self.manifest.stage_complete(video.identifier, 'markdown')]
+
+    def write_all_videos_to_md(self, pipeline=None):
+        pipeline = pipeline or VideoPipeline()
+        return pipeline.run(self.videos.values())
+
+
+class ColumnarSegmentStore:
+    """
+    Compact, memory-mappable store of a video series' segments. Start and end times are float64 columns, the texts are
+    one UTF-8 blob addressed by an int64 offsets column, and each video's details URL is kept once in index.json
+    since url_with_time can be derived from it and the start time. Segment JSON files remain the ground truth;
+    import_json and export_json convert between the two, and the search index reads imported videos from here as
+    long as their segment file hasn't changed since. A video imported again is appended anew and its old rows are
+    listed under 'dead' in index.json for a later compaction.
+    """
+    COLUMNS = {'starts': 'd', 'ends': 'd', 'offsets': 'q'}
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.index_file = self.directory.joinpath('index.json')
+        self.text_file = self.directory.joinpath('text.utf8')
+        self._maps = None
+        if self.index_file.exists():
+            with open(self.index_file, 'r') as fp:
+                self.index = json.load(fp)
+            self._truncate_unindexed()
+        else:
+            self.index = {'rows': 0, 'text_bytes': 0, 'videos': {}}
+
+    def _column_file(self, name):
+        return self.directory.joinpath(f'{name}.{self.COLUMNS[name]}')
+
+    def _truncate_unindexed(self):
+        # rows appended by a run that died before updating index.json are dropped
+        for name, typecode in self.COLUMNS.items():
+            with open(self._column_file(name), 'rb+') as f:
+                f.truncate(self.index['rows'] * array(typecode).itemsize)
+        with open(self.text_file, 'rb+') as f:
+            f.truncate(self.index['text_bytes'])
+
+    def __contains__(self, identifier):
+        return identifier in self.index['videos']
+
+    def identifiers(self):
+        return list(self.index['videos'])
+
+    def append_video(self, identifier, url, segments, source=None, replace=False):
+        if identifier in self and not replace:
+            raise ValueError(f'{identifier} is already in {self.directory}')
+        self.directory.mkdir(parents=True, exist_ok=True)
+        columns = {name: array(typecode) for name, typecode in self.COLUMNS.items()}
+        text_blob = bytearray()
+        url_overrides = {}
+        int_starts = int_ends = True
+        for row, segment in enumerate(segments):
+            columns['starts'].append(segment['start'])
+            columns['ends'].append(segment['end'])
+            columns['offsets'].append(self.index['text_bytes'] + len(text_blob))
+            text_blob += segment['text'].encode('utf-8')
+            int_starts = int_starts and isinstance(segment['start'], int)
+            int_ends = int_ends and isinstance(segment['end'], int)
+            if segment['url_with_time'] != f"{url}?start={int(segment['start'])}":
+                url_overrides[str(row)] = segment['url_with_time']
+        self._close_maps()
+        for name, column in columns.items():
+            with open(self._column_file(name), 'ab') as f:
+                column.tofile(f)
+        with open(self.text_file, 'ab') as f:
+            f.write(text_blob)
+        if identifier in self:
+            replaced = self.index['videos'][identifier]
+            self.index.setdefault('dead', []).append([replaced['row'], replaced['count']])
+        self.index['videos'][identifier] = {'row': self.index['rows'], 'count': len(columns['starts']), 'url': url,
+                                            'int_starts': int_starts, 'int_ends': int_ends,
+                                            'url_overrides': url_overrides, 'source': source}
+        self.index['rows'] += len(columns['starts'])
+        self.index['text_bytes'] += len(text_blob)
+        write_json_atomic(self.index_file, self.index)
 
-    def write_all_videos_to_md(self):
-        for video in self.videos.values():
-            video.markdown_file
+    @staticmethod
+    def _source(segment_file):
+        stat = os.stat(segment_file)
+        return {'path': str(segment_file), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    def import_json(self, identifier, segment_file, url, replace=False):
+        self.append_video(identifier, url, iter_segments(segment_file), source=self._source(segment_file),
+                          replace=replace)
+
+    def is_current(self, identifier, segment_file):
+        """Whether identifier was imported from segment_file as it is on disk now."""
+        video = self.index['videos'].get(identifier)
+        return video is not None and video.get('source') == self._source(segment_file)
+
+    def stale(self, identifier):
+        """Whether the segment file identifier was imported from has changed since, leaving its rows out of date."""
+        source = self.index['videos'][identifier].get('source')
+        return source is not None and Path(source['path']).exists() and not self.is_current(identifier, source['path'])
+
+    def sync(self, video_series):
+        """
+        Imports the segment files of video_series that are recorded in its manifest but not stored yet, or that
+        changed since they were imported.
+        """
+        imported = 0
+        for identifier in video_series.manifest.identifiers():
+            segment_record = video_series.manifest.get(identifier, 'segment')
+            if not segment_record:
+                continue
+            segment_file = segment_record['files'][0]['path']
+            if identifier not in self or not self.is_current(identifier, segment_file):
+                url = video_series.manifest.get(identifier, 'metadata')['url']
+                self.import_json(identifier, segment_file, url, replace=True)
+                imported += 1
+        return imported
+
+    def _close_maps(self):
+        if self._maps:
+            for column in self._maps.values():
+                column.release()
+        self._maps = None
+
+    def _columns(self):
+        if self._maps is None:
+            self._maps = {}
+            for name, path in [(name, self._column_file(name)) for name in self.COLUMNS] + [('text', self.text_file)]:
+                if not path.exists() or path.stat().st_size == 0:
+                    self._maps[name] = memoryview(b'')
+                    continue
+                with open(path, 'rb') as f:
+                    self._maps[name] = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            for name, typecode in self.COLUMNS.items():
+                self._maps[name] = self._maps[name].cast(typecode)
+        return self._maps
+
+    def iter_segments(self, identifier):
+        video = self.index['videos'][identifier]
+        columns = self._columns()
+        first_row = video['row']
+        for row in range(first_row, first_row + video['count']):
+            start = columns['starts'][row]
+            end = columns['ends'][row]
+            text_end = columns['offsets'][row + 1] if row + 1 < self.index['rows'] else self.index['text_bytes']
+            text = bytes(columns['text'][columns['offsets'][row]:text_end]).decode('utf-8')
+            url_with_time = video['url_overrides'].get(str(row - first_row), f"{video['url']}?start={int(start)}")
+            yield TextSegment(int(start) if video['int_starts'] else start,
+                              int(end) if video['int_ends'] else end,
+                              text, url_with_time)
+
+    def scan(self):
+        """Yields (identifier, TextSegment) for every stored segment, skipping videos whose rows are out of date."""
+        for identifier in self.index['videos']:
+            if self.stale(identifier):
+                logger.warning(f'Skipping {identifier} in {self.directory}, its segment file changed since it was '
+                               f'imported')
+                continue
+            for segment in self.iter_segments(identifier):
+                yield identifier, segment
+
+    def export_json(self, identifier, fp):
+        if self.stale(identifier):
+            logger.warning(f'Exporting {identifier} from {self.directory}, but its segment file changed since it was '
+                           f'imported')
+        json.dump([segment.to_dict() for segment in self.iter_segments(identifier)], fp)
+
+
+class SegmentSearchIndex:
+    """
+    SQLite FTS5 index over the segments of every video series. Queries use FTS5 syntax, so "exact phrase" and prefix*
+    searches work, or are plain text whose words must all appear, and hits are ranked by bm25. update() only re-reads
+    segment files whose size or mtime changed, and reads them from a ColumnarSegmentStore when it holds them.
+    """
+    def __init__(self, path='data/search_index.sqlite'):
+        if path != ':memory:':
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._conn = sqlite3.connect(str(path))
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS indexed_files (
+                segment_file TEXT PRIMARY KEY,
+                identifier TEXT,
+                series TEXT,
+                size INTEGER,
+                mtime_ns INTEGER
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS segments USING fts5(
+                text,
+                segment_file UNINDEXED,
+                identifier UNINDEXED,
+                series UNINDEXED,
+                date UNINDEXED,
+                start UNINDEXED,
+                end UNINDEXED,
+                url_with_time UNINDEXED,
+                tokenize = 'porter unicode61'
+            );""")
+
+    def update(self, video_series, store=None):
+        """Indexes new or changed segment files of video_series and returns how many files were (re)indexed."""
+        identifiers = {}
+        for identifier in video_series.manifest.identifiers():
+            record = video_series.manifest.get(identifier, 'segment')
+            if record:
+                identifiers[record['files'][0]['path']] = identifier
+        indexed = {segment_file: (size, mtime_ns) for segment_file, size, mtime_ns in self._conn.execute(
+            'SELECT segment_file, size, mtime_ns FROM indexed_files WHERE series = ?', (video_series.name,))}
+        updated = 0
+        for segment_file in sorted(Path(video_series.segment_dir).glob('*.json')):
+            segment_file = str(segment_file)
+            stat = os.stat(segment_file)
+            if indexed.get(segment_file) == (stat.st_size, stat.st_mtime_ns):
+                continue
+            identifier = identifiers.get(segment_file, Path(segment_file).stem)
+            metadata = video_series.manifest.get(identifier, 'metadata') or {}
+            if store is not None and store.is_current(identifier, segment_file):
+                segments = ((segment.text, segment.start, segment.end, segment.url_with_timestamp)
+                            for segment in store.iter_segments(identifier))
+            else:
+                segments = ((segment['text'], segment['start'], segment['end'], segment['url_with_time'])
+                            for segment in iter_segments(segment_file))
+            with self._conn:
+                self._conn.execute('DELETE FROM segments WHERE segment_file = ?', (segment_file,))
+                self._conn.executemany(
+                    'INSERT INTO segments VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    ((text, segment_file, identifier, video_series.name, metadata.get('date', ''), start, end,
+                      url_with_time) for text, start, end, url_with_time in segments))
+                self._conn.execute('INSERT OR REPLACE INTO indexed_files VALUES (?, ?, ?, ?, ?)',
+                                   (segment_file, identifier, video_series.name, stat.st_size, stat.st_mtime_ns))
+            updated += 1
+        if updated:
+            logger.info(f"Indexed {updated} segment files for {video_series.name}")
+        return updated
+
+    @staticmethod
+    def plain_query(text):
+        # every word becomes a quoted string, so punctuation like - ' . can't be read as FTS5 syntax
+        return ' '.join('"' + word.replace('"', '""') + '"' for word in text.split())
+
+    def search(self, query, series=None, start_date=None, end_date=None, limit=20, plain=False):
+        """Raises sqlite3.OperationalError for a query that isn't valid FTS5 syntax, which a plain query never is."""
+        if plain:
+            query = self.plain_query(query)
+            if not query:
+                return []
+        conditions, parameters = ['segments MATCH ?'], [query]
+        if series:
+            conditions.append('series = ?')
+            parameters.append(series)
+        # IA dates may carry a time, so compare on the date part only
+        if start_date:
+            conditions.append('substr(date, 1, 10) >= ?')
+            parameters.append(str(start_date))
+        if end_date:
+            conditions.append('substr(date, 1, 10) <= ?')
+            parameters.append(str(end_date))
+        rows = self._conn.execute(
+            f'SELECT start, end, text, url_with_time FROM segments WHERE {" AND ".join(conditions)} '
+            f'ORDER BY bm25(segments) LIMIT ?', parameters + [limit])
+        return [TextSegment(start, end, text, url_with_time) for start, end, text, url_with_time in rows]
+
+
+class MarkdownPublisher:
+    """
+    Mirrors the rendered markdown into a git repository by copying only new or changed files, deleting files that
+    are no longer rendered and staging just those paths. Hashes of what was last published are kept in state_file,
+    and unchanged source files (same size and mtime) are not even re-read.
+    """
+    def __init__(self, source_dir, repo_dir, target_dir='meetings', state_file='data/publish_state.json',
+                 metrics=None):
+        self.source_dir = Path(source_dir)
+        self.repo_dir = Path(repo_dir).expanduser()
+        self.target_dir = self.repo_dir.joinpath(target_dir)
+        self.state_file = Path(state_file)
+        self.metrics = metrics
+
+    @classmethod
+    def from_config(cls, config, source_dir='data/markdown', metrics=None):
+        return cls(source_dir, config['repo_dir'], target_dir=config.get('target_dir', 'meetings'),
+                   state_file=config.get('state_file', 'data/publish_state.json'), metrics=metrics)
+
+    def _load_state(self):
+        if not self.state_file.exists():
+            return None
+        with open(self.state_file, 'r') as fp:
+            return json.load(fp)
+
+    def _save_state(self, state):
+        write_json_atomic(self.state_file, state)
+
+    def _git(self, *args):
+        return subprocess.run(['git', '-C', str(self.repo_dir), *args], check=True, capture_output=True)
+
+    def _tracked(self, paths):
+        tracked = set()
+        for batch in chunked(paths, 500):
+            output = self._git('ls-files', '-z', '--', *[str(path.relative_to(self.repo_dir)) for path in batch])
+            tracked.update(output.stdout.decode('utf-8').split('\0'))
+        return [path for path in paths if path.relative_to(self.repo_dir).as_posix() in tracked]
+
+    def publish(self, commit_message=None):
+        start = time.monotonic()
+        previous_state = self._load_state()
+        state, changed, deleted = {}, [], []
+        unchanged = 0
+        for source_file in sorted(self.source_dir.rglob('*.md')):
+            relative_path = source_file.relative_to(self.source_dir).as_posix()
+            target_file = self.target_dir.joinpath(relative_path)
+            stat = source_file.stat()
+            previous = (previous_state or {}).get(relative_path)
+            if previous and (previous['size'], previous['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+                md5 = previous['md5']
+            else:
+                md5 = file_md5(source_file)
+            state[relative_path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'md5': md5}
+            if previous is not None:
+                up_to_date = previous['md5'] == md5 and target_file.exists()
+            else:
+                # first publish, or a file that is new since the last one, so compare with what is in the repo
+                up_to_date = target_file.exists() and file_md5(target_file) == md5
+            if up_to_date:
+                unchanged += 1
+                continue
+            target_file.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(source_file, target_file)
+            changed.append(target_file)
+
+        if previous_state is None:
+            stale_files = [path.relative_to(self.target_dir).as_posix() for path in self.target_dir.rglob('*.md')]
+        else:
+            stale_files = list(previous_state)
+        already_gone = []
+        for relative_path in stale_files:
+            if relative_path not in state:
+                target_file = self.target_dir.joinpath(relative_path)
+                if target_file.exists():
+                    target_file.unlink()
+                    deleted.append(target_file)
+                else:
+                    already_gone.append(target_file)
+        # git add fails on a path that is neither on disk nor tracked, so files already gone are only staged if tracked
+        deleted.extend(self._tracked(already_gone))
+
+        # stage in batches to stay under the command line length limit
+        for paths in chunked(changed + deleted, 500):
+            self._git('add', '--all', '--', *[str(path.relative_to(self.repo_dir)) for path in paths])
+        if commit_message and (changed or deleted):
+            self._git('commit', '-m', commit_message)
+        self._save_state(state)
+        report = {'changed': len(changed), 'deleted': len(deleted), 'unchanged': unchanged}
+        logger.info(f"Published markdown to {self.target_dir}: {report}")
+        if self.metrics is not None:
+            self.metrics.record('publish', time.monotonic() - start,
+                                bytes_in=sum(file['size'] for file in state.values()),
+                                bytes_out=sum(path.stat().st_size for path in changed))
+        return report
+
+
+class ItemMetadataStore:
+    """
+    Persistent sqlite cache of the parts of an IA item we use, so each identifier is fetched from IA once and then
+    served from disk. Entries older than ttl_seconds are refetched and the least recently used entries are evicted
+    once there are more than max_entries.
+    """
+    def __init__(self, path=':memory:', ttl_seconds=7 * 24 * 60 * 60, max_entries=50000):
+        if path != ':memory:':
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS item_metadata (
+                identifier TEXT PRIMARY KEY,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                url TEXT,
+                download_url TEXT,
+                title TEXT,
+                date TEXT,
+                files TEXT
+            )""")
+        self._conn.execute('CREATE INDEX IF NOT EXISTS item_metadata_accessed_at ON item_metadata (accessed_at)')
+        self._conn.commit()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(path=config.get('path', 'data/ia_metadata.sqlite'),
+                   ttl_seconds=config.get('ttl_hours', 7 * 24) * 60 * 60,
+                   max_entries=config.get('max_entries', 50000))
+
+    def get(self, identifier):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT fetched_at, url, download_url, title, date, files FROM item_metadata WHERE identifier = ?',
+                (identifier,)).fetchone()
+            if row is None:
+                return None
+            fetched_at, url, download_url, title, date, files = row
+            if now - fetched_at > self.ttl_seconds:
+                self._conn.execute('DELETE FROM item_metadata WHERE identifier = ?', (identifier,))
+                self._conn.commit()
+                return None
+            self._conn.execute('UPDATE item_metadata SET accessed_at = ? WHERE identifier = ?', (now, identifier))
+            self._conn.commit()
+        return {
+            'identifier': identifier,
+            'fetched_at': fetched_at,
+            'url': url,
+            'download_url': download_url,
+            'title': title,
+            'date': date,
+            'files': json.loads(files),
+        }
+
+    def put(self, metadata):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO item_metadata VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (metadata['identifier'], metadata.get('fetched_at', now), now, metadata['url'],
+                 metadata['download_url'], metadata['title'], metadata['date'], json.dumps(metadata['files'])))
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now):
+        self._conn.execute('DELETE FROM item_metadata WHERE fetched_at < ?', (now - self.ttl_seconds,))
+        self._conn.execute("""
+            DELETE FROM item_metadata WHERE identifier IN (
+                SELECT identifier FROM item_metadata ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)""",
+                           (self.max_entries,))
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM item_metadata').fetchone()[0]
+
+
+class TranscriptCache:
+    """
+    Content addressed store of finished transcripts, so a meeting uploaded again under another identifier or title
+    is transcribed once. Entries are keyed on a sha256 of the decoded 16 kHz audio together with model_params (model
+    size, compute type and transcription settings) and hold the audio duration and the segments' start, end and
+    text; URLs are rewritten for the video that hits. Least recently used entries are evicted once the cache holds
+    more than max_bytes.
+    """
+    def __init__(self, directory='data/transcript_cache', model_params=None, max_bytes=2 * 1000 ** 3):
+        self.directory = Path(directory)
+        self.model_params = model_params or {}
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config):
+        model_params = {'model_size': config.get('model_size'), 'compute_type': config.get('compute_type'),
+                        'transcription': config.get('transcription', {})}
+        cache_config = config.get('transcript_cache', {})
+        return cls(directory=cache_config.get('directory', 'data/transcript_cache'), model_params=model_params,
+                   max_bytes=int(cache_config.get('max_gb', 2) * 1000 ** 3))
+
+    @staticmethod
+    def audio_fingerprint(source):
+        # the 16 bit samples are hashed frame by frame as they are decoded, so no copy of the whole meeting is ever
+        # held in memory, and audio files and videos go through the same decoder
+        import av
+        digest = hashlib.sha256()
+        resampler = av.audio.resampler.AudioResampler(format='s16', layout='mono', rate=SAMPLING_RATE)
+        with av.open(str(source), metadata_errors='ignore') as container:
+            for frame in container.decode(audio=0):
+                for resampled in resampler.resample(frame):
+                    digest.update(resampled.to_ndarray().tobytes())
+        for resampled in resampler.resample(None):
+            digest.update(resampled.to_ndarray().tobytes())
+        return digest.hexdigest()
+
+    def key(self, source):
+        return hashlib.sha256(json.dumps({'audio': self.audio_fingerprint(source),
+                                          **self.model_params}, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _entry_file(self, key):
+        return self.directory.joinpath(f'{key}.json')
+
+    def get(self, key):
+        """Returns {'duration': ..., 'segments': [...]} or None."""
+        try:
+            with open(self._entry_file(key), 'r') as fp:
+                entry = json.load(fp)
+            os.utime(self._entry_file(key))
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put(self, key, segments, duration=None):
+        write_json_atomic(self._entry_file(key), {
+            'duration': duration,
+            'segments': [{'start': segment['start'], 'end': segment['end'], 'text': segment['text']}
+                         for segment in segments]})
+        self._evict()
+
+    def _entries(self):
+        entries = []
+        for entry_file in self.directory.glob('*.json'):
+            try:
+                stat = entry_file.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_file))
+        return sorted(entries)
+
+    def _evict(self):
+        with self._lock:
+            entries = self._entries()
+            total_bytes = sum(size for _, size, _ in entries)
+            for _, size, entry_file in entries:
+                if total_bytes <= self.max_bytes:
+                    break
+                entry_file.unlink(missing_ok=True)
+                total_bytes -= size
+
+    def __len__(self):
+        return len(self._entries())
+
+
+class VideoDownloader:
+    """
+    Downloads files over a pooled HTTP session with at most max_connections transfers in flight. Files are written to
+    <target>.part and only renamed to the target once their size and md5 match, so a partial download never looks
+    finished. An existing .part file is resumed with an HTTP Range request.
+    """
+    def __init__(self, session=None, max_connections=4, chunk_size=1024 * 1024, timeout=60):
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.session = session or requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.max_connections = max_connections
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.bytes_downloaded = 0
+        self.download_seconds = 0.0
+        self.downloads = 0
+        self._connections = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+
+    @property
+    def bytes_per_second(self):
+        # average rate of a single connection while it was transferring
+        return self.bytes_downloaded / self.download_seconds if self.download_seconds else 0.0
+
+    def metrics(self):
+        return {'downloads': self.downloads, 'bytes_downloaded': self.bytes_downloaded,
+                'download_seconds': round(self.download_seconds, 3),
+                'bytes_per_second': round(self.bytes_per_second, 1)}
+
+    def download(self, url, target_filepath, expected_size=None, expected_md5=None):
+        target_filepath = Path(target_filepath)
+        part_filepath = target_filepath.with_name(target_filepath.name + '.part')
+        expected_size = int(expected_size) if expected_size is not None else None
+        with self._connections:
+            resume_from = part_filepath.stat().st_size if part_filepath.exists() else 0
+            if expected_size is not None and resume_from > expected_size:
+                resume_from = 0
+            headers = {'Range': f'bytes={resume_from}-'} if resume_from else {}
+            bytes_downloaded = 0
+            start = time.monotonic()
+            with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                # 416 means the .part file already holds everything
+                if response.status_code != 416:
+                    response.raise_for_status()
+                    if resume_from and response.status_code == 206:
+                        logger.info(f'Resuming {target_filepath} from byte {resume_from}')
+                        mode = 'ab'
+                    else:
+                        mode = 'wb'
+                    with open(part_filepath, mode) as f:
+                        for chunk in response.iter_content(chunk_size=self.chunk_size):
+                            bytes_downloaded += f.write(chunk)
+            with self._lock:
+                self.downloads += 1
+                self.bytes_downloaded += bytes_downloaded
+                self.download_seconds += time.monotonic() - start
+
+        size = part_filepath.stat().st_size
+        if expected_size is not None and size != expected_size:
+            part_filepath.unlink()
+            raise IOError(f'Downloaded {size} bytes of {url} but expected {expected_size}')
+        if expected_md5 and file_md5(part_filepath) != expected_md5:
+            part_filepath.unlink()
+            raise IOError(f'md5 of {url} does not match {expected_md5}')
+        os.replace(part_filepath, target_filepath)
+        return str(target_filepath)
+
+    def download_many(self, downloads):
+        """Runs several (url, target_filepath, expected_size, expected_md5) downloads at once."""
+        with ThreadPoolExecutor(max_workers=self.max_connections) as executor:
+            return list(executor.map(lambda download: self.download(*download), downloads))
 
 
 class IAVideoFetcher:
-    def __init__(self, preferred_formats=['h.264'], start_date=None):
-        # See if you can replace with access keys
-        assert os.getenv('IA_USERNAME') and os.getenv(
-            'IA_PASSWORD'), "IA_USERNAME and IA_PASSWORD environment variables must be set"
-        configure(username=os.getenv('IA_USERNAME'), password=os.getenv('IA_PASSWORD'))
-        self.session = get_session()
-        self.preferred_formats = preferred_formats
+    def __init__(self, preferred_formats=['h.264'], start_date=None, metadata_store=None, max_connections=4,
+                 audio_formats=[], session=None):
+        # an already configured ArchiveSession, e.g. one pointed at a local stand in for IA, needs no credentials.
+        # Otherwise the session is only set up once something actually talks to IA.
+        self._session = session
+        self._downloader = None
+        self.max_connections = max_connections
+        self.metadata_store = metadata_store or ItemMetadataStore()
+        self.preferred_formats = [preferred_format.lower() for preferred_format in preferred_formats]
+        self.audio_formats = [audio_format.lower() for audio_format in audio_formats]
         if start_date:
             self.start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
         else:
             self.start_date = datetime.today().date() - timedelta(days=31)
         self.end_date = datetime.today().date() + timedelta(days=1)
 
+    @property
+    def session(self):
+        if self._session is None:
+            from internetarchive import configure, get_session
+            # See if you can replace with access keys
+            assert os.getenv('IA_USERNAME') and os.getenv(
+                'IA_PASSWORD'), "IA_USERNAME and IA_PASSWORD environment variables must be set"
+            configure(username=os.getenv('IA_USERNAME'), password=os.getenv('IA_PASSWORD'))
+            self._session = get_session()
+        return self._session
+
+    @property
+    def downloader(self):
+        if self._downloader is None:
+            self._downloader = VideoDownloader(session=self.session, max_connections=self.max_connections)
+        return self._downloader
+
+    def download_metrics(self):
+        # without touching downloader, which would set up an IA session just to report nothing was downloaded
+        return self._downloader.metrics() if self._downloader is not None else {}
+
     def get_video_series_identifiers(self, video_series):
         date_constrained_query = self.add_date_to_query(video_series.ia_seach_query)
         search_results = self.session.search_items(date_constrained_query)
@@ -318,43 +1329,454 @@ class IAVideoFetcher:
     def add_date_to_query(self, query):
         return f'({query}) AND date:[{self.start_date} TO {self.end_date}]'
 
+    def get_item_metadata(self, identifier):
+        metadata = self.metadata_store.get(identifier)
+        if metadata is None:
+            item = self.session.get_item(identifier)
+            metadata = {
+                'identifier': identifier,
+                'url': item.urls.details,
+                'download_url': item.urls.download,
+                'title': item.metadata['title'],
+                'date': item.metadata['date'],
+                'files': [{key: file[key] for key in ('name', 'format', 'size', 'md5') if key in file}
+                          for file in item.files],
+            }
+            self.metadata_store.put(metadata)
+        return metadata
+
+    def select_media_file(self, files):
+        """
+        Picks the smallest file in a preferred format. Audio derivatives are ranked ahead of any video since they
+        save both the video download and the ffmpeg decode.
+        """
+        candidates = [file for file in files
+                      if file['format'].lower() in self.audio_formats + self.preferred_formats]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda file: (file['format'].lower() not in self.audio_formats,
+                                                 int(file.get('size') or sys.maxsize)))
+
     def get_video_file_name(self, identifier):
-        item = get_item(identifier)
-        for file in item.files:
-            # TODO: find smallest video file
-            if file['format'].lower() in self.preferred_formats:
-                return file['name']
+        file = self.select_media_file(self.get_item_metadata(identifier)['files'])
+        if file:
+            return file['name']
         logger.warning(f'No video in preferred format found for {identifier}')
         return
 
+    def get_file_size(self, identifier, file_name):
+        file = next((file for file in self.get_item_metadata(identifier)['files'] if file['name'] == file_name), {})
+        return int(file['size']) if file.get('size') else None
+
     def download_video_file(self, identifier, file_name, target_filepath):
-        item = get_item(identifier)
+        metadata = self.get_item_metadata(identifier)
+        file = next((file for file in metadata['files'] if file['name'] == file_name), {})
         logger.info(f'Downloading {identifier}:{file_name}')
-        file_obj = File(item, file_name)
-        file_obj.download(file_path=str(target_filepath))
-        return target_filepath
-
+        return self.downloader.download(f"{metadata['download_url']}/{quote(file_name)}", target_filepath,
+                                        expected_size=file.get('size'), expected_md5=file.get('md5'))
 
     def get_video_metadata(self, identifier):
-        item = get_item(identifier)
-        return item.urls.details, item.metadata['title'], item.metadata['date']
+        metadata = self.get_item_metadata(identifier)
+        return metadata['url'], metadata['title'], metadata['date']
+
+
+class IASeriesDiscovery:
+    """
+    Finds new items for all video series at once. Blocking search_items calls run in threads under asyncio, and a first
+    run over a long date range is split into window_days windows that are searched in parallel. The latest date and
+    addeddate seen for each series are kept in state_file, and later runs only ask for items added since then. A
+    series' new mark is only saved by commit, once its identifiers are recorded, so a run that dies in between
+    searches from the old mark again instead of skipping what it found.
+    """
+    FIELDS = ['identifier', 'date', 'addeddate']
+
+    def __init__(self, search_backend, start_date, end_date, state_file='data/discovery_state.json', window_days=90,
+                 max_concurrency=8):
+        # search_backend needs search_items(query, fields=...), e.g. an internetarchive ArchiveSession, which pages
+        # through the scrape API itself
+        self.search_backend = search_backend
+        self.start_date = start_date
+        self.end_date = end_date
+        self.state_file = Path(state_file)
+        self.window_days = window_days
+        self.max_concurrency = max_concurrency
+        if self.state_file.exists():
+            with open(self.state_file, 'r') as fp:
+                self.state = json.load(fp)
+        else:
+            self.state = {}
+        self.new_marks = {}
 
-    # def get_video_date(self, identifier):
-    #     item = get_item(identifier)
-    #     return
-    #
-    # def get_video_url(self, identifier):
-    #     item = get_item(identifier)
-    #     return
+    @classmethod
+    def from_config(cls, config, fetcher):
+        return cls(fetcher.session, fetcher.start_date, fetcher.end_date,
+                   state_file=config.get('state_file', 'data/discovery_state.json'),
+                   window_days=config.get('window_days', 90),
+                   max_concurrency=config.get('max_concurrency', 8))
+
+    def date_windows(self):
+        windows = []
+        window_start = self.start_date
+        while window_start <= self.end_date:
+            window_end = min(window_start + timedelta(days=self.window_days - 1), self.end_date)
+            windows.append((window_start, window_end))
+            window_start = window_end + timedelta(days=1)
+        return windows
+
+    def queries(self, video_series):
+        date_range = f'date:[{self.start_date} TO {self.end_date}]'
+        high_water_mark = self.state.get(video_series.name, {}).get('addeddate')
+        if high_water_mark:
+            # inclusive, so items added later on the same day are not missed; repeats are dropped by identifier
+            return [f'({video_series.ia_seach_query}) AND {date_range} AND addeddate:[{high_water_mark} TO '
+                    f'{self.end_date}]']
+        return [f'({video_series.ia_seach_query}) AND date:[{window_start} TO {window_end}]'
+                for window_start, window_end in self.date_windows()]
+
+    async def _search(self, query, semaphore):
+        async with semaphore:
+            return await asyncio.to_thread(lambda: list(self.search_backend.search_items(query, fields=self.FIELDS)))
+
+    async def _discover_series(self, video_series, semaphore):
+        # let every window finish before reporting a failure, so no searches are left running in the background
+        window_results = await asyncio.gather(*[self._search(query, semaphore)
+                                                for query in self.queries(video_series)], return_exceptions=True)
+        for result in window_results:
+            if isinstance(result, Exception):
+                raise result
+        identifiers = []
+        mark = dict(self.state.get(video_series.name, {}))
+        for result in window_results:
+            for item in result:
+                if item['identifier'] not in identifiers:
+                    identifiers.append(item['identifier'])
+                for field in ('date', 'addeddate'):
+                    if item.get(field) and item[field][:10] > mark.get(field, ''):
+                        mark[field] = item[field][:10]
+        return identifiers, mark
+
+    async def discover(self, all_video_series):
+        """
+        Returns {series name: new identifiers}. A series whose search fails keeps its mark and maps to []. The marks
+        of the others are held until commit.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        results = await asyncio.gather(*[self._discover_series(video_series, semaphore)
+                                         for video_series in all_video_series], return_exceptions=True)
+        discovered = {}
+        for video_series, result in zip(all_video_series, results):
+            if isinstance(result, Exception):
+                logger.error(f'Searching for {video_series.name} failed: {result!r}')
+                discovered[video_series.name] = []
+                continue
+            discovered[video_series.name], self.new_marks[video_series.name] = result
+            logger.info(f'Found {len(result[0])} {video_series.name} items')
+        return discovered
+
+    def commit(self, video_series):
+        """Moves the series' mark past what discover found, to be called once those identifiers are recorded."""
+        if video_series.name in self.new_marks:
+            self.state[video_series.name] = self.new_marks.pop(video_series.name)
+            self.save_state()
+
+    def save_state(self):
+        write_json_atomic(self.state_file, self.state, indent=2)
+
+
+# plain picklable stand ins for faster_whisper's Segment and TranscriptionInfo, used to return results from worker
+# processes and for segments shifted back onto the original timeline
+TranscribedSegment = namedtuple('TranscribedSegment', ['start', 'end', 'text'])
+TranscriptionSummary = namedtuple('TranscriptionSummary', ['duration', 'skipped_duration', 'decode_seconds'],
+                                  defaults=[0.0, 0.0])
+
+SAMPLING_RATE = 16000
+
+
+class SpeechDetector:
+    """
+    Cheap energy based voice activity detection. Frames louder than threshold_db (dBFS) count as speech, bursts
+    shorter than min_speech_seconds are ignored, regions are padded by padding_seconds and silences shorter than
+    min_silence_seconds are bridged, so recesses and pre-roll drop out while pauses between speakers don't split
+    the audio into tiny chunks.
+    """
+    def __init__(self, threshold_db=-40.0, frame_seconds=0.03, min_speech_seconds=0.25, min_silence_seconds=2.0,
+                 padding_seconds=0.3, sampling_rate=SAMPLING_RATE):
+        self.threshold_db = threshold_db
+        self.frame_length = max(1, int(frame_seconds * sampling_rate))
+        self.min_speech_frames = int(min_speech_seconds * sampling_rate / self.frame_length)
+        self.min_silence_samples = int(min_silence_seconds * sampling_rate)
+        self.padding_samples = int(padding_seconds * sampling_rate)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(threshold_db=config.get('threshold_db', -40.0),
+                   min_speech_seconds=config.get('min_speech_seconds', 0.25),
+                   min_silence_seconds=config.get('min_silence_seconds', 2.0),
+                   padding_seconds=config.get('padding_seconds', 0.3))
+
+    def frame_energy_db(self, audio):
+        import numpy as np
+        n_frames = -(-len(audio) // self.frame_length)
+        frames = np.pad(audio, (0, n_frames * self.frame_length - len(audio))).reshape(n_frames, self.frame_length)
+        rms = np.sqrt(np.mean(np.square(frames, dtype=np.float32), axis=1))
+        return 20 * np.log10(np.maximum(rms, 1e-10))
+
+    def regions(self, audio):
+        """Returns the (start, end) sample ranges of audio that contain speech, in order."""
+        import numpy as np
+        if len(audio) == 0:
+            return []
+        voiced = np.concatenate(([0], self.frame_energy_db(audio) > self.threshold_db, [0])).astype(np.int8)
+        edges = np.diff(voiced)
+        regions = []
+        for start_frame, end_frame in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)):
+            if end_frame - start_frame < self.min_speech_frames:
+                continue
+            start = max(0, int(start_frame) * self.frame_length - self.padding_samples)
+            end = min(len(audio), int(end_frame) * self.frame_length + self.padding_samples)
+            if regions and start - regions[-1][1] < self.min_silence_samples:
+                regions[-1] = (regions[-1][0], end)
+            else:
+                regions.append((start, end))
+        return regions
 
 
 class Transcriber:
-    def __init__(self, transcribing_model):
+    def __init__(self, transcribing_model, beam_size=5, vad_filter=False, chunk_length=None, batch_size=None,
+                 speech_detector=None):
         self.transcribing_model = transcribing_model
+        self.beam_size = beam_size
+        self.vad_filter = vad_filter
+        self.chunk_length = chunk_length
+        self.batch_size = batch_size
+        self.speech_detector = speech_detector
+        self.audio_seconds = 0.0
+        self.skipped_seconds = 0.0
+        self.wall_seconds = 0.0
+
+    @classmethod
+    def from_config(cls, config, transcribing_model):
+        # batched inference runs the VAD chunks of a file through the model batch_size at a time
+        batch_size = config.get('batch_size')
+        if batch_size:
+            from faster_whisper import BatchedInferencePipeline
+            transcribing_model = BatchedInferencePipeline(model=transcribing_model)
+        silence_trimming = config.get('silence_trimming')
+        return cls(transcribing_model,
+                   beam_size=config.get('beam_size', 5),
+                   vad_filter=config.get('vad_filter', False),
+                   chunk_length=config.get('chunk_length'),
+                   batch_size=batch_size,
+                   speech_detector=SpeechDetector.from_config(silence_trimming) if silence_trimming else None)
+
+    @property
+    def throughput(self):
+        # audio seconds transcribed per wall second
+        return self.audio_seconds / self.wall_seconds if self.wall_seconds else 0.0
+
+    @property
+    def skipped_fraction(self):
+        # share of the audio that silence trimming kept away from the model
+        return self.skipped_seconds / self.audio_seconds if self.audio_seconds else 0.0
+
+    def transcription_options(self):
+        options = {'beam_size': self.beam_size, 'vad_filter': self.vad_filter}
+        if self.chunk_length:
+            options['chunk_length'] = self.chunk_length
+        if self.batch_size:
+            options['batch_size'] = self.batch_size
+            # BatchedInferencePipeline finds its chunks with the VAD and raises on audio longer than a chunk without it
+            options['vad_filter'] = True
+        return options
+
+    def transcribe(self, audio_fp, offset=0.0, extract_audio=False):
+        """
+        Returns a lazy segments generator and the transcription info. A non-zero offset seeks the audio to that many
+        seconds in and shifts the segment times back so they still line up with the source video. With extract_audio
+        audio_fp is a video whose audio is piped out of ffmpeg rather than read from an audio file. With a
+        speech_detector only the speech regions are transcribed and info.skipped_duration is the silence left out.
+        info.decode_seconds is the time spent decoding the audio before the model saw it.
+        """
+        start = time.monotonic()
+        # decoding starts at the offset, so what was transcribed before a resume isn't decoded again
+        if extract_audio:
+            audio = video2pcm(audio_fp, offset=offset)
+        elif offset:
+            audio = decode_pcm(audio_fp, offset=offset)
+        elif self.speech_detector:
+            from faster_whisper import decode_audio
+            audio = decode_audio(audio_fp, sampling_rate=SAMPLING_RATE)
+        else:
+            audio = audio_fp
+        # an audio file handed to the model as is gets decoded inside it, which can't be timed apart
+        decode_seconds = time.monotonic() - start if audio is not audio_fp else 0.0
+        if self.speech_detector:
+            regions = self.speech_detector.regions(audio)
+            segments = self._transcribe_regions(audio, regions, offset)
+            duration = len(audio) / SAMPLING_RATE
+            speech_duration = sum(end - begin for begin, end in regions) / SAMPLING_RATE
+            info = TranscriptionSummary(duration, duration - speech_duration, decode_seconds)
+        else:
+            segments, info = self.transcribing_model.transcribe(audio, **self.transcription_options())
+            info = TranscriptionSummary(info.duration, getattr(info, 'skipped_duration', 0.0), decode_seconds)
+            if offset:
+                segments = (TranscribedSegment(segment.start + offset, segment.end + offset, segment.text)
+                            for segment in segments)
+        return self._timed(audio_fp, segments, info, start), info
+
+    def _transcribe_regions(self, audio, regions, offset=0.0):
+        # each region is its own chunk, its segment times are shifted back to where the region sits in the source
+        for begin, end in regions:
+            region_offset = offset + begin / SAMPLING_RATE
+            segments, _ = self.transcribing_model.transcribe(audio[begin:end], **self.transcription_options())
+            for segment in segments:
+                yield TranscribedSegment(segment.start + region_offset, segment.end + region_offset, segment.text)
+
+    def _timed(self, audio_fp, segments, info, start):
+        yield from segments
+        wall_seconds = time.monotonic() - start
+        skipped_duration = getattr(info, 'skipped_duration', 0.0)
+        self.audio_seconds += info.duration
+        self.skipped_seconds += skipped_duration
+        self.wall_seconds += wall_seconds
+        logger.info(f"Transcribed {info.duration:.0f}s of audio from {audio_fp} in {wall_seconds:.0f}s "
+                    f"({info.duration / wall_seconds if wall_seconds else 0:.2f}x realtime, "
+                    f"{skipped_duration / info.duration if info.duration else 0:.0%} silence skipped)")
+
+    def transcribe_batch(self, audio_fps):
+        """
+        Transcribes each audio file and yields (audio_fp, segments, info) as soon as that file is finished, with the
+        segments already materialized.
+        """
+        for audio_fp in audio_fps:
+            segments, info = self.transcribe(audio_fp)
+            yield audio_fp, list(segments), info
+
+
+def load_whisper_model(model_size, device='cuda', compute_type='float16', cpu_threads=0):
+    from faster_whisper import WhisperModel
+    return WhisperModel(model_size, device=device, compute_type=compute_type, cpu_threads=cpu_threads)
+
+
+_worker_transcriber = None
 
-    def transcribe(self, audio_fp):
-        segments, info = self.transcribing_model.transcribe(audio_fp, beam_size=5)
-        return segments, info
+
+def _init_transcriber_worker(model_factory, model_kwargs, transcription_config):
+    global _worker_transcriber
+    _worker_transcriber = Transcriber.from_config(transcription_config, transcribing_model=model_factory(**model_kwargs))
+
+
+def _transcribe_in_worker(audio_fp, offset=0.0, extract_audio=False, segment_queue=None):
+    # with a segment_queue every segment is sent back as soon as the model yields it, followed by None once done
+    start = time.monotonic()
+    try:
+        segments, info = _worker_transcriber.transcribe(audio_fp, offset, extract_audio)
+        segments = (TranscribedSegment(segment.start, segment.end, segment.text) for segment in segments)
+        if segment_queue is None:
+            segments = list(segments)
+        else:
+            for segment in segments:
+                segment_queue.put(segment)
+            segments = None
+    finally:
+        if segment_queue is not None:
+            segment_queue.put(None)
+    return segments, info, os.getpid(), time.monotonic() - start
+
+
+class PendingTranscriptionSummary:
+    """TranscriptionSummary of a transcription still running in a worker, filled in once its segments run out."""
+    def __init__(self):
+        self.duration = None
+        self.skipped_duration = 0.0
+        self.decode_seconds = 0.0
+
+
+class ShardedTranscriber:
+    """
+    Spreads transcription over num_workers processes that each load their own model once, typically an int8 model
+    on the CPU with cpu_threads threads per worker. Pending audio files are handed to whichever worker is free, and
+    transcribe streams their segments back as the worker produces them so they can be checkpointed along the way.
+    """
+    def __init__(self, num_workers, model_kwargs, transcription_config=None, model_factory=load_whisper_model):
+        self.num_workers = num_workers
+        self.worker_stats = {}
+        self.audio_seconds = 0.0
+        self.skipped_seconds = 0.0
+        self.wall_seconds = 0.0
+        self._lock = threading.Lock()
+        self._manager = None
+        self._executor = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn'),
+                                             initializer=_init_transcriber_worker,
+                                             initargs=(model_factory, model_kwargs, transcription_config or {}))
+
+    @classmethod
+    def from_config(cls, config):
+        model_kwargs = {'model_size': config['model_size'], 'device': config.get('device', 'cpu'),
+                        'compute_type': config['compute_type'], 'cpu_threads': config.get('cpu_threads', 0)}
+        return cls(config['transcription_workers'], model_kwargs, config.get('transcription', {}))
+
+    @property
+    def throughput(self):
+        return self.audio_seconds / self.wall_seconds if self.wall_seconds else 0.0
+
+    @property
+    def skipped_fraction(self):
+        return self.skipped_seconds / self.audio_seconds if self.audio_seconds else 0.0
+
+    def _record(self, audio_fp, info, pid, wall_seconds):
+        with self._lock:
+            self.audio_seconds += info.duration
+            self.skipped_seconds += info.skipped_duration
+            self.wall_seconds += wall_seconds
+            stats = self.worker_stats.setdefault(pid, {'files': 0, 'audio_seconds': 0.0, 'skipped_seconds': 0.0,
+                                                       'wall_seconds': 0.0})
+            stats['files'] += 1
+            stats['audio_seconds'] += info.duration
+            stats['skipped_seconds'] += info.skipped_duration
+            stats['wall_seconds'] += wall_seconds
+        logger.info(f"Worker {pid} transcribed {info.duration:.0f}s of audio from {audio_fp} in {wall_seconds:.0f}s "
+                    f"(realtime factor {wall_seconds / info.duration if info.duration else 0:.2f})")
+
+    def transcribe(self, audio_fp, offset=0.0, extract_audio=False):
+        """
+        Returns a lazy segments generator fed by the worker and a summary whose duration is set once the generator is
+        exhausted.
+        """
+        with self._lock:
+            if self._manager is None:
+                self._manager = multiprocessing.get_context('spawn').Manager()
+            segment_queue = self._manager.Queue()
+        future = self._executor.submit(_transcribe_in_worker, audio_fp, offset, extract_audio, segment_queue)
+        summary = PendingTranscriptionSummary()
+        return self._stream(audio_fp, future, segment_queue, summary), summary
+
+    def _stream(self, audio_fp, future, segment_queue, summary):
+        while (segment := segment_queue.get()) is not None:
+            yield segment
+        # raises what the worker raised, after the segments it did produce
+        _, info, pid, wall_seconds = future.result()
+        summary.duration, summary.skipped_duration, summary.decode_seconds = info
+        self._record(audio_fp, info, pid, wall_seconds)
+
+    def transcribe_batch(self, audio_fps):
+        futures = {self._executor.submit(_transcribe_in_worker, audio_fp): audio_fp for audio_fp in audio_fps}
+        for future in as_completed(futures):
+            segments, info, pid, wall_seconds = future.result()
+            self._record(futures[future], info, pid, wall_seconds)
+            yield futures[future], segments, info
+
+    def worker_report(self):
+        # realtime factor is wall time over audio time, so below 1 is faster than realtime
+        with self._lock:
+            return {pid: {**stats, 'realtime_factor': stats['wall_seconds'] / stats['audio_seconds']
+                          if stats['audio_seconds'] else 0.0}
+                    for pid, stats in self.worker_stats.items()}
+
+    def close(self):
+        self._executor.shutdown()
+        if self._manager is not None:
+            self._manager.shutdown()
 
 
 def video2audio(video_fp, audio_fp):
@@ -362,6 +1784,7 @@ def video2audio(video_fp, audio_fp):
     # if not Path(audio_dir).exists():
     #     Path(audio_dir).mkdir()
     # audio_fp = f'{audio_dir}/{audio_fn}'
+    from ffmpeg import FFmpeg
     ffmpeg = (
         FFmpeg()
         .option("vn")
@@ -372,39 +1795,716 @@ def video2audio(video_fp, audio_fp):
     return audio_fp
 
 
-if __name__ == '__main__':
-    # updates identifiers for each video series in config and then writes them to markdown. Any missing videos
-    # are downloaded and transcribed.
+def video2pcm(video_fp, sampling_rate=SAMPLING_RATE, offset=0.0):
+    """
+    Decodes the audio track of video_fp to mono float32 samples read straight from an ffmpeg pipe, skipping the mp3
+    encode and audio file that video2audio produces. ffmpeg seeks to offset seconds before decoding.
+    """
+    import numpy as np
+    from ffmpeg import FFmpeg
+    ffmpeg = (
+        FFmpeg()
+        .input(video_fp, {'ss': offset} if offset else None)
+        .output('pipe:1', {'vn': None, 'f': 's16le', 'ac': 1, 'ar': sampling_rate}))
+    pcm = ffmpeg.execute()
+    return np.frombuffer(pcm, np.int16).astype(np.float32) / 32768.0
+
+
+def decode_pcm(media_fp, offset=0.0, sampling_rate=SAMPLING_RATE):
+    """
+    Decodes media_fp to mono float32 samples from offset seconds on. The container is seeked to the packet at or
+    before offset and only the few samples decoded ahead of it are dropped, unlike faster_whisper's decode_audio,
+    which always decodes from the start.
+    """
+    import av
+    import numpy as np
+    resampler = av.audio.resampler.AudioResampler(format='s16', layout='mono', rate=sampling_rate)
+    chunks = []
+    first_frame_time = None
+    with av.open(str(media_fp), metadata_errors='ignore') as container:
+        stream = container.streams.audio[0]
+        if offset:
+            container.seek(int(offset / stream.time_base), stream=stream)
+        for frame in container.decode(stream):
+            if first_frame_time is None:
+                first_frame_time = float(frame.pts * frame.time_base) if frame.pts is not None else 0.0
+            chunks.extend(resampled.to_ndarray().reshape(-1) for resampled in resampler.resample(frame))
+    chunks.extend(resampled.to_ndarray().reshape(-1) for resampled in resampler.resample(None))
+    audio = np.concatenate(chunks) if chunks else np.zeros(0, np.int16)
+    ahead = max(0, round((offset - (first_frame_time or 0.0)) * sampling_rate))
+    return audio[ahead:].astype(np.float32) / 32768.0
+
+
+class RunMetrics:
+    """
+    Wall time, bytes in and out and media duration of every stage a video goes through in a run, summed per stage,
+    per series and per video for a JSON run report and optionally a Prometheus textfile for node_exporter. The
+    realtime factor is stage wall time over media duration, so below 1 is faster than realtime.
+    """
+    PROMETHEUS_PREFIX = 'searchable_ia'
+
+    def __init__(self):
+        self.started = time.time()
+        self.records = []
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds, series=None, identifier=None, bytes_in=0, bytes_out=0, media_seconds=None):
+        with self._lock:
+            self.records.append({'stage': stage, 'series': series, 'identifier': identifier, 'seconds': seconds,
+                                 'bytes_in': bytes_in, 'bytes_out': bytes_out, 'media_seconds': media_seconds})
+
+    def _media_seconds(self, records):
+        # a video's duration is only known once it is transcribed, so earlier stages borrow it from there
+        media_seconds = {}
+        for record in records:
+            if record['media_seconds'] is not None:
+                media_seconds[(record['series'], record['identifier'])] = record['media_seconds']
+        return media_seconds
 
-    from faster_whisper import WhisperModel
-    import ruamel.yaml as yaml
-    import logging
-    import requests_cache
+    @staticmethod
+    def _totals(records, media_seconds):
+        totals = {'count': len(records), 'seconds': 0.0, 'bytes_in': 0, 'bytes_out': 0, 'media_seconds': 0.0}
+        timed_media_seconds = 0.0
+        for record in records:
+            totals['seconds'] += record['seconds']
+            totals['bytes_in'] += record['bytes_in']
+            totals['bytes_out'] += record['bytes_out']
+            duration = media_seconds.get((record['series'], record['identifier']))
+            if duration:
+                totals['media_seconds'] += duration
+                timed_media_seconds += record['seconds']
+        totals['realtime_factor'] = timed_media_seconds / totals['media_seconds'] if totals['media_seconds'] else None
+        return {key: round(value, 3) if isinstance(value, float) else value for key, value in totals.items()}
+
+    def _grouped(self, records, media_seconds, key):
+        groups = {}
+        for record in records:
+            groups.setdefault(key(record), []).append(record)
+        return {group: self._totals(group_records, media_seconds) for group, group_records in groups.items()}
+
+    def summary(self):
+        with self._lock:
+            records = list(self.records)
+        media_seconds = self._media_seconds(records)
+        series_records, video_records = {}, {}
+        for record in records:
+            if record['series'] is not None:
+                series_records.setdefault(record['series'], []).append(record)
+            if record['identifier'] is not None:
+                video_records.setdefault(record['identifier'], []).append(record)
+        by_stage = lambda record: record['stage']
+        return {
+            'started_at': datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+            'elapsed_seconds': round(time.time() - self.started, 3),
+            'stages': self._grouped(records, media_seconds, by_stage),
+            'series': {series: self._grouped(series_group, media_seconds, by_stage)
+                       for series, series_group in series_records.items()},
+            'videos': {identifier: {'series': video_group[0]['series'],
+                                    'media_seconds': media_seconds.get((video_group[0]['series'], identifier)),
+                                    'stages': self._grouped(video_group, media_seconds, by_stage)}
+                       for identifier, video_group in video_records.items()},
+        }
 
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.INFO)
-    logger.addHandler(logging.StreamHandler())
-    logger.addHandler(logging.FileHandler('searchable_internet_archive_videos.log'))
+    def write_json(self, path, **extra):
+        """Writes the summary plus any extra sections, e.g. the pipeline's queue report, to path."""
+        return write_json_atomic(path, {**self.summary(), **extra}, indent=2)
 
-    requests_cache.install_cache('ia_cache', backend='sqlite', expire_after=60*60)
+    @staticmethod
+    def _prometheus_labels(**labels):
+        escaped = {name: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                   for name, value in labels.items()}
+        return '{' + ','.join(f'{name}="{value}"' for name, value in escaped.items()) + '}'
+
+    def prometheus_lines(self):
+        summary = self.summary()
+        metrics = [('videos_total', 'count', 'counter', 'Videos that went through the stage'),
+                   ('stage_seconds_total', 'seconds', 'counter', 'Wall time spent in the stage'),
+                   ('stage_bytes_in_total', 'bytes_in', 'counter', 'Bytes read by the stage'),
+                   ('stage_bytes_out_total', 'bytes_out', 'counter', 'Bytes written by the stage'),
+                   ('media_seconds_total', 'media_seconds', 'counter', 'Seconds of media handled by the stage'),
+                   ('realtime_factor', 'realtime_factor', 'gauge', 'Stage wall time over media duration')]
+        rows = [({'series': series, 'stage': stage}, totals)
+                for series, stages in summary['series'].items() for stage, totals in stages.items()]
+        # stages that don't belong to a series, like publish
+        rows += [({'series': '', 'stage': stage}, totals) for stage, totals in summary['stages'].items()
+                 if not any(stage in stages for stages in summary['series'].values())]
+        lines = []
+        for name, key, metric_type, help_text in metrics:
+            lines.append(f'# HELP {self.PROMETHEUS_PREFIX}_{name} {help_text}.')
+            lines.append(f'# TYPE {self.PROMETHEUS_PREFIX}_{name} {metric_type}')
+            lines.extend(f'{self.PROMETHEUS_PREFIX}_{name}{self._prometheus_labels(**labels)} {totals[key]}'
+                         for labels, totals in rows if totals[key] is not None)
+        lines.append(f'# HELP {self.PROMETHEUS_PREFIX}_last_run_timestamp_seconds Start of the last run.')
+        lines.append(f'# TYPE {self.PROMETHEUS_PREFIX}_last_run_timestamp_seconds gauge')
+        lines.append(f'{self.PROMETHEUS_PREFIX}_last_run_timestamp_seconds {self.started:.0f}')
+        return lines
+
+    def write_prometheus(self, path):
+        # written aside and renamed so the textfile collector never reads a half written file
+        with atomic_open(path) as fp:
+            fp.write('\n'.join(self.prometheus_lines()) + '\n')
+        return Path(path)
+
+
+class WorkScheduler:
+    """
+    Decides the order pending videos go through the pipeline and keeps downloaded media within a disk budget.
+    Videos of all series are ordered newest first, or by series priority and then newest first, so a backlog of old
+    meetings never holds up new ones. Once a video's segments are persisted its video file, and its audio file unless
+    the series keeps audio, is deleted, and downloads wait while the media on disk is over budget.
+    """
+    ORDERS = ('recency', 'priority')
+
+    def __init__(self, order='recency', priorities=None, disk_budget_bytes=None, delete_media=None):
+        if order not in self.ORDERS:
+            raise ValueError(f'order must be one of {self.ORDERS}, not {order!r}')
+        self.order_by = order
+        self.priorities = priorities or {}
+        self.disk_budget_bytes = disk_budget_bytes
+        # a budget can only be kept by deleting what was transcribed
+        self.delete_media = disk_budget_bytes is not None if delete_media is None else delete_media
+        self.bytes_used = 0
+        self.peak_bytes = 0
+        self.bytes_freed = 0
+        self.throttled_seconds = 0.0
+        self._in_flight = set()
+        self._reserved = {}
+        self._condition = threading.Condition()
 
-    config = yaml.safe_load(open('config.yaml'))
+    @classmethod
+    def from_config(cls, config, all_video_series=()):
+        disk_budget_gb = config.get('disk_budget_gb')
+        scheduler = cls(order=config.get('order', 'recency'), priorities=config.get('priorities'),
+                        disk_budget_bytes=int(disk_budget_gb * 1e9) if disk_budget_gb else None,
+                        delete_media=config.get('delete_media'))
+        scheduler.measure(all_video_series)
+        return scheduler
+
+    @property
+    def over_budget(self):
+        return self.disk_budget_bytes is not None and self.bytes_used >= self.disk_budget_bytes
+
+    def measure(self, all_video_series):
+        """Counts the video and audio already on disk, e.g. left by an earlier run, against the budget."""
+        bytes_used = sum(path.stat().st_size for video_series in all_video_series
+                         for directory in (video_series.video_dir, video_series.audio_dir)
+                         for path in Path(directory).glob('*') if path.is_file())
+        with self._condition:
+            self.bytes_used = bytes_used
+            self.peak_bytes = max(self.peak_bytes, bytes_used)
+        return bytes_used
+
+    def order(self, videos):
+        """Newest first, or by series priority and then newest first. Videos without a date go last."""
+        videos = sorted(videos, key=lambda video: video.date or '', reverse=True)
+        if self.order_by == 'priority':
+            # sort is stable, so videos of equally important series stay newest first
+            videos.sort(key=lambda video: self.priorities.get(video.video_series.name, 0), reverse=True)
+        return videos
+
+    @staticmethod
+    def _key(video):
+        return video.video_series.name, video.identifier
+
+    def hold_media_on_disk(self, videos):
+        """
+        Returns videos in the order to feed them to the pipeline. Media an earlier run left on disk is only freed by
+        transcribing it, so when that media alone fills the budget its videos go first and count as in flight, and
+        downloads of newer videos wait on them instead of failing. Otherwise every video keeps its place.
+        """
+        videos = list(videos)
+        if not self.over_budget:
+            return videos
+        on_disk = [video for video in videos
+                   if any(Path(path).exists() for path in (video._video_file, video._audio_file))]
+        with self._condition:
+            self._in_flight.update(self._key(video) for video in on_disk)
+        held = {self._key(video) for video in on_disk}
+        return on_disk + [video for video in videos if self._key(video) not in held]
+
+    def _fits(self, expected_bytes):
+        return self.disk_budget_bytes is None or (
+            self.bytes_used < self.disk_budget_bytes
+            and self.bytes_used + expected_bytes <= self.disk_budget_bytes)
+
+    def admit(self, video, expected_bytes=None):
+        """
+        Blocks a download until its expected_bytes, the size IA lists for the file, fit in the budget and reserves
+        them, so concurrent downloads can't each take the last of the room. While it doesn't fit, it waits for videos
+        in flight to free some; with nothing left to free, the video is left for a later run.
+        """
+        expected_bytes = expected_bytes or 0
+        with self._condition:
+            start = time.monotonic()
+            while not self._fits(expected_bytes) and self._in_flight:
+                self._condition.wait()
+            self.throttled_seconds += time.monotonic() - start
+            if not self._fits(expected_bytes):
+                raise IOError(f'{expected_bytes} bytes of {video.identifier} don\'t fit the budget of '
+                              f'{self.disk_budget_bytes} bytes with {self.bytes_used} bytes of media on disk, '
+                              f'leaving it for a later run')
+            self._in_flight.add(self._key(video))
+            self._reserved[self._key(video)] = expected_bytes
+            self.bytes_used += expected_bytes
+            self.peak_bytes = max(self.peak_bytes, self.bytes_used)
+
+    def track(self, video, path):
+        """Counts a file the video wrote, in place of what was reserved for it."""
+        size = Path(path).stat().st_size
+        with self._condition:
+            self.bytes_used += size - self._reserved.pop(self._key(video), 0)
+            self.peak_bytes = max(self.peak_bytes, self.bytes_used)
+            self._condition.notify_all()
+
+    def release(self, video):
+        """Deletes the intermediate media of a video whose segments are persisted. Returns the bytes freed."""
+        if not self.delete_media or not video.video_series.manifest.stage_complete(video.identifier, 'segment') \
+                or not Path(video._segment_file).exists():
+            return 0
+        paths = [video._video_file] + ([] if video.video_series.keep_audio else [video._audio_file])
+        freed = 0
+        for path in paths:
+            try:
+                size = Path(path).stat().st_size
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            freed += size
+        if freed:
+            logger.info(f'Deleted {freed} bytes of media transcribed for {video.identifier}')
+        with self._condition:
+            self.bytes_used = max(self.bytes_used - freed, 0)
+            self.bytes_freed += freed
+            self._condition.notify_all()
+        return freed
+
+    def release_completed(self, videos):
+        """Deletes media that earlier runs left behind after transcribing it."""
+        return sum(self.release(video) for video in videos)
+
+    def finish(self, video):
+        # the video is out of the pipeline, finished or failed, and no longer holds up downloads waiting on it
+        with self._condition:
+            self._in_flight.discard(self._key(video))
+            # a download that failed never wrote what it reserved
+            self.bytes_used -= self._reserved.pop(self._key(video), 0)
+            self._condition.notify_all()
+
+    def report(self):
+        return {
+            'order': self.order_by,
+            'disk_budget_bytes': self.disk_budget_bytes,
+            'bytes_used': self.bytes_used,
+            'peak_bytes': self.peak_bytes,
+            'bytes_freed': self.bytes_freed,
+            'throttled_seconds': round(self.throttled_seconds, 3),
+        }
+
+
+class StageStats:
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.processed = 0
+        self.skipped = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self.max_queue_depth = 0
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def record(self, outcome, seconds, queue_depth):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            self.busy_seconds += seconds
+            self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def throughput(self):
+        # videos per second of stage wall time, only counting videos the stage actually worked on
+        return self.processed / self.elapsed if self.elapsed else 0.0
+
+    def to_dict(self):
+        return {
+            'workers': self.workers,
+            'processed': self.processed,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'busy_seconds': round(self.busy_seconds, 3),
+            'elapsed_seconds': round(self.elapsed, 3),
+            'throughput_per_second': round(self.throughput, 4),
+            'max_queue_depth': self.max_queue_depth,
+        }
+
+
+class VideoPipeline:
+    """
+    Runs download, extract, transcribe and render as separate stages connected by bounded queues so that
+    downloading and ffmpeg work overlap with transcription. Downloads run on I/O threads, audio extraction in a
+    process pool and transcription on a single worker that owns the model, or one worker per process of a
+    ShardedTranscriber.
+    """
+    _DONE = object()
+
+    def __init__(self, download_workers=4, extract_workers=2, transcribe_workers=1, render_workers=1, queue_size=8,
+                 audio_extractor=video2audio, extract_processes=True, report_interval=60, metrics=None,
+                 scheduler=None):
+        self.stage_workers = {
+            'download': download_workers,
+            'extract': extract_workers,
+            'transcribe': transcribe_workers,
+            'render': render_workers,
+        }
+        self.queue_size = queue_size
+        self.audio_extractor = audio_extractor
+        self.extract_processes = extract_processes
+        self.report_interval = report_interval
+        self.metrics = metrics
+        self.scheduler = scheduler
+        self.stats = {}
+        self.queues = {}
+        self._extract_executor = None
+
+    @classmethod
+    def from_config(cls, config, transcribe_workers=1, metrics=None, scheduler=None):
+        return cls(download_workers=config.get('download_workers', 4),
+                   extract_workers=config.get('extract_workers', 2),
+                   transcribe_workers=transcribe_workers,
+                   render_workers=config.get('render_workers', 1),
+                   queue_size=config.get('queue_size', 8),
+                   report_interval=config.get('report_interval', 60),
+                   metrics=metrics,
+                   scheduler=scheduler)
+
+    def _download(self, video):
+        if not video.stage_needed('audio'):
+            return False
+        media_file = video._audio_file if video.audio_only else video._video_file
+        downloading = self.scheduler is not None and not Path(media_file).exists()
+        if downloading:
+            self.scheduler.admit(video, video.video_series.video_fetcher.get_file_size(video.identifier,
+                                                                                       video.video_file_name))
+        if video.audio_only:
+            video.audio_file
+        else:
+            video.video_file
+        if downloading:
+            self.scheduler.track(video, video._audio_file if video.audio_only else video._video_file)
+        return True
+
+    def _extract(self, video):
+        if not video.stage_needed('audio') or video.streams_audio:
+            return False
+        video._audio_file = self._extract_executor.submit(
+            self.audio_extractor, video.video_file, video._audio_file).result()
+        video.record_stage('audio', [video._audio_file])
+        if self.scheduler is not None:
+            self.scheduler.track(video, video._audio_file)
+        return True
+
+    def _transcribe(self, video):
+        transcribed = video.stage_needed('segment')
+        if transcribed:
+            video.segment_file
+        if self.scheduler is not None:
+            self.scheduler.release(video)
+        return transcribed
+
+    def _render(self, video):
+        if not video.stage_needed('markdown'):
+            return False
+        video._write_markdown_file()
+        return True
+
+    @staticmethod
+    def _stage_io(name, video):
+        # bytes in and out come from the file sizes the manifest recorded for the stage and the one before it
+        manifest = video.video_series.manifest
+        downloaded_stage = 'audio' if video.audio_only else 'video'
+        input_stage, output_stage = {
+            'download': (downloaded_stage, downloaded_stage),
+            'extract': ('video', 'audio'),
+            'transcribe': ('audio' if manifest.stage_complete(video.identifier, 'audio') else 'video', 'segment'),
+            'render': ('segment', 'markdown'),
+        }[name]
+
+        def recorded_bytes(stage):
+            record = manifest.get(video.identifier, stage) or {}
+            return sum(file['size'] for file in record.get('files', []))
+        segment_record = manifest.get(video.identifier, 'segment') or {}
+        return {'bytes_in': recorded_bytes(input_stage), 'bytes_out': recorded_bytes(output_stage),
+                'media_seconds': segment_record.get('duration') if name == 'transcribe' else None}
+
+    def queue_depths(self):
+        return {name: q.qsize() for name, q in self.queues.items()}
+
+    def report(self):
+        return {name: stats.to_dict() for name, stats in self.stats.items()}
+
+    def _stage_worker(self, name, work, next_name, remaining_workers):
+        stats = self.stats[name]
+        in_queue = self.queues[name]
+        out_queue = self.queues.get(next_name)
+        while True:
+            video = in_queue.get()
+            if video is self._DONE:
+                break
+            queue_depth = in_queue.qsize()
+            start = time.monotonic()
+            try:
+                outcome = 'processed' if work(video) else 'skipped'
+            except Exception:
+                logger.exception(f"{name} failed for {video.identifier}")
+                stats.record('failed', time.monotonic() - start, queue_depth)
+                if self.scheduler is not None:
+                    self.scheduler.finish(video)
+                continue
+            seconds = time.monotonic() - start
+            stats.record(outcome, seconds, queue_depth)
+            if self.metrics is not None and outcome == 'processed':
+                stage_io = self._stage_io(name, video)
+                if name == 'transcribe' and video.decode_seconds:
+                    # decoding is reported as its own stage, or streamed audio would hide it in the model's time
+                    self.metrics.record('decode', video.decode_seconds, series=video.video_series.name,
+                                        identifier=video.identifier, bytes_in=stage_io['bytes_in'])
+                    seconds -= video.decode_seconds
+                self.metrics.record(name, seconds, series=video.video_series.name, identifier=video.identifier,
+                                    **stage_io)
+            if out_queue is not None:
+                out_queue.put(video)
+            elif self.scheduler is not None:
+                self.scheduler.finish(video)
+        # the last worker out tells the next stage there is nothing more coming
+        with stats._lock:
+            remaining_workers[name] -= 1
+            last_worker = remaining_workers[name] == 0
+        if last_worker:
+            stats.finished = time.monotonic()
+            if out_queue is not None:
+                for _ in range(self.stage_workers[next_name]):
+                    out_queue.put(self._DONE)
+
+    def _log_progress(self, stop):
+        while not stop.wait(self.report_interval):
+            logger.info(f"Pipeline queue depths: {self.queue_depths()}")
+
+    def run(self, videos, stages=None):
+        """Runs videos through every stage, or only through the named stages when stages is given."""
+        work = {'download': self._download, 'extract': self._extract,
+                'transcribe': self._transcribe, 'render': self._render}
+        stage_names = [name for name in self.stage_workers if stages is None or name in stages]
+        self.queues = {name: queue.Queue(maxsize=self.queue_size) for name in stage_names}
+        self.stats = {name: StageStats(name, self.stage_workers[name]) for name in stage_names}
+        remaining_workers = {name: self.stage_workers[name] for name in stage_names}
+        executor_class = ProcessPoolExecutor if self.extract_processes else ThreadPoolExecutor
+        self._extract_executor = executor_class(max_workers=self.stage_workers['extract'])
+
+        threads = []
+        for name, next_name in zip(stage_names, stage_names[1:] + [None]):
+            self.stats[name].started = time.monotonic()
+            for worker in range(self.stage_workers[name]):
+                thread = threading.Thread(target=self._stage_worker, name=f'{name}-{worker}',
+                                          args=(name, work[name], next_name, remaining_workers),
+                                          daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        stop_reporting = threading.Event()
+        reporter = threading.Thread(target=self._log_progress, args=(stop_reporting,), daemon=True)
+        reporter.start()
+        if self.scheduler is not None:
+            videos = self.scheduler.hold_media_on_disk(videos)
+        try:
+            for video in videos:
+                self.queues[stage_names[0]].put(video)
+            for _ in range(self.stage_workers[stage_names[0]]):
+                self.queues[stage_names[0]].put(self._DONE)
+            for thread in threads:
+                thread.join()
+        finally:
+            stop_reporting.set()
+            self._extract_executor.shutdown()
+
+        report = self.report()
+        for name, stage_report in report.items():
+            logger.info(f"Stage {name}: {stage_report}")
+        return report
+
+
+def load_config(path='config.yaml'):
+    from ruamel.yaml import YAML
+    with open(path, 'r') as fp:
+        return YAML(typ='safe').load(fp)
+
+
+def build_transcriber(config):
+    transcription_workers = config.get('transcription_workers', 1)
+    if transcription_workers > 1:
+        logger.info(f'loading Whisper model in {transcription_workers} worker processes')
+        return ShardedTranscriber.from_config(config)
     logger.info('loading Whisper model')
-    model = WhisperModel(config['model_size'],
-                         device="cuda",
-                         compute_type=config['compute_type']
-                         )
+    model = load_whisper_model(config['model_size'],
+                               device=config.get('device', 'cuda'),
+                               compute_type=config['compute_type'],
+                               cpu_threads=config.get('cpu_threads', 0))
+    return Transcriber.from_config(config.get('transcription', {}), transcribing_model=model)
+
+
+def build_video_series(config, video_fetcher=None, transcript_cache=None, metrics=None):
+    return [VideoSeries.from_config(config=video_series_config, keep_audio=config.get('keep_audio', False),
+                                    video_fetcher=video_fetcher, transcript_cache=transcript_cache, metrics=metrics)
+            for video_series_config in config['meeting_video_series']]
+
+
+# stages of the VideoPipeline each command runs, None being all of them
+COMMAND_STAGES = {'run': None, 'fetch': ['download', 'extract'], 'transcribe': ['download', 'extract', 'transcribe'],
+                  'render': ['render']}
+
+
+def main(argv=None):
+    """
+    Entry point. The default run discovers new items, then downloads, transcribes, renders, indexes and publishes
+    whatever is pending. Subcommands run single steps, search the local index or report progress from the manifests.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Find, transcribe and search Internet Archive videos.')
+    parser.add_argument('--config', default='config.yaml')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('run', help='discover, fetch, transcribe, render, index and publish (the default)')
+    subparsers.add_parser('discover', help='search IA for new items and record their metadata')
+    subparsers.add_parser('fetch', help='download known videos, extracting their audio with keep_audio')
+    subparsers.add_parser('transcribe', help='fetch and transcribe known videos')
+    subparsers.add_parser('render', help='write markdown for transcribed videos')
+    search_parser = subparsers.add_parser('search', help='query the local transcript index')
+    search_parser.add_argument('query', help='words that must all appear, or with --fts an FTS5 query, e.g. '
+                                             '\'"stop sign"\' or \'zon*\'')
+    search_parser.add_argument('--fts', action='store_true', help='read the query as FTS5 syntax')
+    search_parser.add_argument('--series', help='only search this video series')
+    search_parser.add_argument('--start-date', help='only search videos dated on or after YYYY-MM-DD')
+    search_parser.add_argument('--end-date', help='only search videos dated on or before YYYY-MM-DD')
+    search_parser.add_argument('--limit', type=int, default=20)
+    subparsers.add_parser('status', help='show per series progress from the manifests')
+    args = parser.parse_args(argv)
+    command = args.command or 'run'
+
+    logger.setLevel(logging.INFO)
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+        logger.addHandler(logging.FileHandler('searchable_internet_archive_videos.log'))
+
+    config = load_config(args.config)
+
+    if command == 'status':
+        discovery_state_file = Path(config.get('discovery', {}).get('state_file', 'data/discovery_state.json'))
+        discovery_state = json.loads(discovery_state_file.read_text()) if discovery_state_file.exists() else {}
+        for video_series in build_video_series(config):
+            counts = video_series.status()
+            added = discovery_state.get(video_series.name, {}).get('addeddate', 'never')
+            print(f"{video_series.name}: {counts['videos']} videos, "
+                  + ', '.join(f'{counts[stage]} {stage}' for stage in SearchableVideo.STAGES)
+                  + f", {counts['pending']} pending, newest item added {added}")
+        return
 
-    transcriber = Transcriber(transcribing_model=model)
+    search_index = SegmentSearchIndex(config.get('search_index', 'data/search_index.sqlite'))
+    if command == 'search':
+        for video_series in build_video_series(config):
+            search_index.update(video_series, ColumnarSegmentStore(video_series.columnar_dir))
+        try:
+            hits = search_index.search(args.query, series=args.series, start_date=args.start_date,
+                                       end_date=args.end_date, limit=args.limit, plain=not args.fts)
+        except sqlite3.OperationalError as error:
+            parser.error(f'invalid FTS5 query {args.query!r}: {error}')
+        for segment in hits:
+            print(f"{timedelta(seconds=int(segment.start))} {segment.text.strip()} {segment.url_with_timestamp}")
+        return
 
+    metrics = RunMetrics()
     fetcher = IAVideoFetcher(start_date=config['start_date'],
-                             preferred_formats=config['preferred_formats'])
-    for video_series_config in config['meeting_video_series']:
-        video_series = VideoSeries.from_config(config=video_series_config,
-                                               video_fetcher=fetcher, transcriber=transcriber)
-        logger.info(f'Updating {video_series.name} indentifiers')
-        video_series.update_identifiers()
-        logger.info(f'Writing {video_series.name} to markdown')
-        video_series.write_all_videos_to_md()
-
-    time.sleep(15)
+                             preferred_formats=config['preferred_formats'],
+                             metadata_store=ItemMetadataStore.from_config(config.get('metadata_cache', {})),
+                             max_connections=config.get('max_connections', 4),
+                             audio_formats=config.get('audio_formats', []))
+    transcript_cache = TranscriptCache.from_config(config) if config.get('transcript_cache') else None
+    all_video_series = build_video_series(config, fetcher, transcript_cache, metrics)
+    if command in ('run', 'discover'):
+        logger.info('Updating video series identifiers')
+        discovery = IASeriesDiscovery.from_config(config.get('discovery', {}), fetcher)
+        discovered = asyncio.run(discovery.discover(all_video_series))
+    else:
+        # the other steps only work on videos an earlier discover put in the manifests
+        discovered = {video_series.name: [] for video_series in all_video_series}
+    pending_videos = []
+    for video_series in all_video_series:
+        video_series.update_identifiers(discovered[video_series.name])
+        if command in ('run', 'discover'):
+            discovery.commit(video_series)
+        pending_videos.extend(video_series.pending_videos())
+    if command == 'discover':
+        for video_series in all_video_series:
+            logger.info(f'{video_series.name}: {len(discovered[video_series.name])} found, '
+                        f'{len(video_series.pending_videos())} pending')
+        return
+
+    stages = COMMAND_STAGES[command]
+    if command == 'render':
+        pending_videos = [video for video in pending_videos if video.stage_complete('segment')]
+    scheduler = WorkScheduler.from_config(config.get('scheduler', {}), all_video_series)
+    scheduler.release_completed(video for video_series in all_video_series for video in video_series.videos.values())
+    pending_videos = scheduler.order(pending_videos)
+    transcriber = None
+    transcription_workers = config.get('transcription_workers', 1)
+    if (stages is None or 'transcribe' in stages) and any(video.stage_needed('segment') for video in pending_videos):
+        transcriber = build_transcriber(config)
+        for video_series in all_video_series:
+            video_series.transcriber = transcriber
+
+    logger.info(f'Running {len(pending_videos)} videos through {stages or "all stages"}')
+    pipeline = VideoPipeline.from_config(config.get('pipeline', {}), transcribe_workers=transcription_workers,
+                                         metrics=metrics, scheduler=scheduler)
+    pipeline_report = pipeline.run(pending_videos, stages=stages)
+    logger.info(f'Downloads: {fetcher.download_metrics()}')
+    logger.info(f'Scheduler: {scheduler.report()}')
+    transcription_report = {}
+    if transcriber is not None:
+        logger.info(f'Silence trimming skipped {transcriber.skipped_fraction:.1%} of the audio')
+        transcription_report = {'audio_seconds': transcriber.audio_seconds, 'wall_seconds': transcriber.wall_seconds,
+                                'skipped_fraction': transcriber.skipped_fraction}
+        if transcription_workers > 1:
+            logger.info(f'Transcription workers: {transcriber.worker_report()}')
+            transcriber.close()
+    if transcript_cache is not None:
+        logger.info(f'Transcript cache: {transcript_cache.hits} hits, {transcript_cache.misses} misses')
+
+    if command == 'run':
+        for video_series in all_video_series:
+            # the store is synced first so the index reads new transcripts from it rather than their JSON
+            store = ColumnarSegmentStore(video_series.columnar_dir)
+            store.sync(video_series)
+            search_index.update(video_series, store)
+        if config.get('publish'):
+            MarkdownPublisher.from_config(config['publish'], metrics=metrics).publish(
+                commit_message=config['publish'].get('commit_message', 'Update markdown files'))
+
+    metrics_config = config.get('metrics', {})
+    report_file = Path(metrics_config.get('report_dir', 'data/run_reports')).joinpath(
+        f"{command}_{datetime.fromtimestamp(metrics.started):%Y%m%d_%H%M%S}.json")
+    metrics.write_json(report_file, pipeline=pipeline_report, downloads=fetcher.download_metrics(),
+                       transcription=transcription_report, scheduler=scheduler.report())
+    logger.info(f'Run report written to {report_file}')
+    if metrics_config.get('prometheus_textfile'):
+        metrics.write_prometheus(metrics_config['prometheus_textfile'])
+
+    if command == 'run':
+        time.sleep(15)
+
+
+if __name__ == '__main__':
+    main()
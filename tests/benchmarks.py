@@ -0,0 +1,348 @@
+"""
+Offline benchmarks. Run from the tests directory with `python benchmarks.py`, or `python benchmarks.py 1 100` to
+pick the end-to-end scenarios. The end-to-end scenarios talk to a local stand in for IA, so no credentials, GPU or
+network are needed.
+"""
+import argparse
+import asyncio
+import filecmp
+import hashlib
+import http.server
+import json
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from datetime import date, timedelta
+from pathlib import Path
+from urllib.parse import parse_qs, unquote, urlparse
+
+from internetarchive import get_session
+from tabulate import tabulate
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from searchable_internet_archive_videos import SearchableVideo, chunk_write_md_file, markdown_table_lines, \
+    ColumnarSegmentStore, TextSegment, IAVideoFetcher, IASeriesDiscovery, MarkdownPublisher, RunMetrics, \
+    Transcriber, VideoPipeline, VideoSeries
+
+TEST_ASSET = Path(__file__).resolve().parent.joinpath('test_assets', 'Oprah Commerical - CTV.mp4')
+
+WORDS = ['council', 'motion', 'second', 'budget', 'zoning', 'public', 'comment', 'approve', 'the', 'a', 'of', 'to']
+
+
+def synthetic_segments(n_segments, seed=0):
+    rng = random.Random(seed)
+    return [{'start': i * 4, 'end': i * 4 + 3.9,
+             'text': ' ' + ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 25))) + '.',
+             'url_with_time': f'https://archive.org/details/synthetic-meeting?start={i * 4}'}
+            for i in range(n_segments)]
+
+
+def legacy_chunk_write_md_file(md_path, i, header: str, body_lines: list, max_bytes=345 * 1000):
+    # the recursive chunk writer that the streaming renderer replaced
+    bytes_written = 0
+    with open(md_path.with_stem(f"{md_path.stem}_{i}"), 'wb') as f:
+        bytes_written += f.write(header.encode('utf-8'))
+        for l, line in enumerate(body_lines):
+            line = line+'\n'
+            bytes_written += f.write(line.encode('utf-8'))
+            if bytes_written >= max_bytes:
+                break
+    if l < len(body_lines) - 1:
+        legacy_chunk_write_md_file(md_path, i + 1, header, body_lines[l+1:], max_bytes)
+
+
+def legacy_render(md_path, header_lines, segments):
+    values_list = [SearchableVideo.prettify_segment(segment) for segment in segments]
+    segments_md = tabulate(values_list, tablefmt='github', headers=['Time', 'Transcript', 'Video'])
+    md = SearchableVideo.remove_md_table_whitespace('\n'.join(header_lines) + '\n' + segments_md)
+    md_lines = md.splitlines()
+    legacy_chunk_write_md_file(md_path, 0, '\n'.join(md_lines[0:4]) + '\n', md_lines[4:])
+
+
+def streaming_render(md_path, header_lines, segments):
+    values_list = [SearchableVideo.prettify_segment(segment) for segment in segments]
+    md_header_lines, md_body_lines = markdown_table_lines(header_lines, values_list)
+    chunk_write_md_file(md_path, 0, '\n'.join(md_header_lines) + '\n', md_body_lines)
+
+
+def bench_markdown_render(n_segments=50000):
+    segments = synthetic_segments(n_segments)
+    header_lines = ['## [Synthetic Meeting](https://archive.org/details/synthetic-meeting)', '### 2023-01-01']
+    timings = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, render in (('legacy', legacy_render), ('streaming', streaming_render)):
+            Path(tmp_dir, name).mkdir()
+            start = time.perf_counter()
+            render(Path(tmp_dir, name, 'meeting.md'), header_lines, segments)
+            timings[name] = time.perf_counter() - start
+        comparison = filecmp.dircmp(Path(tmp_dir, 'legacy'), Path(tmp_dir, 'streaming'))
+        assert not (comparison.diff_files or comparison.left_only or comparison.right_only), \
+            'streaming renderer output differs from tabulate'
+        chunks = len(comparison.common_files)
+    print(f"markdown render, {n_segments} segments, {chunks} chunks: legacy {timings['legacy']:.2f}s, "
+          f"streaming {timings['streaming']:.2f}s ({timings['legacy'] / timings['streaming']:.1f}x)")
+    return timings
+
+
+def bench_segment_scan(n_videos=200, n_segments=2000):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        json_dir = Path(tmp_dir, 'json')
+        json_dir.mkdir()
+        store = ColumnarSegmentStore(Path(tmp_dir, 'columnar'))
+        for v in range(n_videos):
+            segments = synthetic_segments(n_segments, seed=v)
+            with open(json_dir.joinpath(f'video{v}.json'), 'w') as fp:
+                json.dump(segments, fp)
+            store.append_video(f'video{v}', 'https://archive.org/details/synthetic-meeting', segments)
+        json_bytes = sum(path.stat().st_size for path in json_dir.iterdir())
+        columnar_bytes = sum(path.stat().st_size for path in Path(tmp_dir, 'columnar').iterdir())
+
+        start = time.perf_counter()
+        json_hits = 0
+        for path in json_dir.iterdir():
+            with open(path) as fp:
+                segments = [TextSegment(s['start'], s['end'], s['text'], s['url_with_time']) for s in json.load(fp)]
+            json_hits += sum('zoning' in segment.text for segment in segments)
+        json_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        columnar_hits = sum('zoning' in segment.text for _, segment in ColumnarSegmentStore(store.directory).scan())
+        columnar_seconds = time.perf_counter() - start
+        assert json_hits == columnar_hits
+    print(f"segment scan, {n_videos * n_segments} segments: json {json_bytes / 1e6:.1f} MB {json_seconds:.2f}s, "
+          f"columnar {columnar_bytes / 1e6:.1f} MB {columnar_seconds:.2f}s")
+    return {'json': json_seconds, 'columnar': columnar_seconds}
+
+
+class FakeIA:
+    """
+    Catalog behind FakeIAHandler: n_videos items spread over n_series subjects, one meeting a day from start_date,
+    each with an h.264 file cut from the test asset to media_bytes so large scenarios stay small on disk.
+    """
+    def __init__(self, n_videos, n_series=5, media_bytes=64 * 1024, start_date=date(2020, 1, 1), page_size=1000):
+        self.media = TEST_ASSET.read_bytes()[:media_bytes]
+        self.media_md5 = hashlib.md5(self.media).hexdigest()
+        self.page_size = page_size
+        self.series = [f'Bench{s}' for s in range(n_series)]
+        self.items = {}
+        for i in range(n_videos):
+            meeting_date = start_date + timedelta(days=i // n_series)
+            identifier = f'bench-{i:05d}'
+            self.items[identifier] = {
+                'identifier': identifier, 'subject': self.series[i % n_series],
+                'date': meeting_date.isoformat(), 'addeddate': f'{meeting_date + timedelta(days=1)} 12:00:00',
+                'title': f'{self.series[i % n_series]} Meeting {i:05d}',
+            }
+        self.end_date = start_date + timedelta(days=max(n_videos - 1, 0) // n_series)
+        self.requests = {'search': 0, 'metadata': 0, 'download': 0}
+
+    def search(self, query):
+        subject = re.search(r'subject:\((\w+)\)', query).group(1)
+        low, high = re.search(r'AND date:\[(\S+) TO (\S+)\]', query).groups()
+        added = re.search(r'addeddate:\[(\S+) TO', query)
+        return [item for item in self.items.values()
+                if item['subject'] == subject and low <= item['date'] <= high
+                and (not added or item['addeddate'][:10] >= added.group(1))]
+
+    def metadata(self, identifier):
+        item = self.items[identifier]
+        return {'metadata': {'identifier': identifier, 'mediatype': 'movies', 'title': item['title'],
+                             'date': item['date'], 'subject': item['subject'], 'addeddate': item['addeddate']},
+                'files': [{'name': f'{identifier}.mp4', 'format': 'h.264 IA', 'size': str(len(self.media)),
+                           'md5': self.media_md5},
+                          {'name': f'{identifier}.thumbs/{identifier}_000001.jpg', 'format': 'Thumbnail',
+                           'size': '4000'}]}
+
+
+class FakeIAHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the scrape search API, the metadata API and downloads (with Range) for FakeIAHandler.fake_ia."""
+    fake_ia = None
+
+    def _send(self, body, content_type='application/json', status=200, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/services/search/v1/scrape':
+            return self._send(b'{}', status=404)
+        self.fake_ia.requests['search'] += 1
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        items = self.fake_ia.search(params['q'])
+        fields = params.get('fields', 'identifier').split(',')
+        page_size = min(int(params.get('count', 10000)), self.fake_ia.page_size)
+        cursor = int(params.get('cursor') or 0)
+        page = {'items': [{field: item[field] for field in fields} for item in items[cursor:cursor + page_size]],
+                'count': len(items[cursor:cursor + page_size]), 'total': len(items)}
+        if cursor + page_size < len(items):
+            page['cursor'] = str(cursor + page_size)
+        self._send(json.dumps(page).encode('utf-8'))
+
+    def do_GET(self):
+        path = unquote(urlparse(self.path).path)
+        if path.startswith('/metadata/'):
+            self.fake_ia.requests['metadata'] += 1
+            return self._send(json.dumps(self.fake_ia.metadata(path[len('/metadata/'):])).encode('utf-8'))
+        if path.startswith('/download/'):
+            self.fake_ia.requests['download'] += 1
+            start = 0
+            if 'Range' in self.headers:
+                start = int(re.match(r'bytes=(\d+)-', self.headers['Range']).group(1))
+            body = self.fake_ia.media[start:]
+            if start:
+                return self._send(body, 'video/mp4', 206, [('Content-Range', f'bytes {start}-'
+                                                                              f'{len(self.fake_ia.media) - 1}/'
+                                                                              f'{len(self.fake_ia.media)}')])
+            return self._send(body, 'video/mp4')
+        self._send(b'{}', status=404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class fake_ia_server:
+    """Context manager that serves a FakeIA on a free local port and yields an ArchiveSession pointed at it."""
+    def __init__(self, fake_ia):
+        self.fake_ia = fake_ia
+
+    def __enter__(self):
+        handler = type('BoundFakeIAHandler', (FakeIAHandler,), {'fake_ia': self.fake_ia})
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        session = get_session()
+        # ArchiveSession only accepts archive.org hosts in its config, so it is pointed at the server afterwards
+        session.host = f'127.0.0.1:{self.server.server_port}'
+        session.protocol = 'http:'
+        return session
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+BenchSegment = namedtuple('BenchSegment', ['start', 'end', 'text'])
+BenchInfo = namedtuple('BenchInfo', ['duration'])
+
+
+class BenchStubModel:
+    """
+    Deterministic stand in for WhisperModel. Every input counts as media_seconds of audio, yields one synthetic
+    segment every segment_seconds and takes media_seconds / speed seconds, i.e. speed times realtime.
+    """
+    def __init__(self, media_seconds=600, segment_seconds=10, speed=float('inf')):
+        self.media_seconds = media_seconds
+        self.segment_seconds = segment_seconds
+        self.speed = speed
+
+    def transcribe(self, audio, **options):
+        rng = random.Random(str(audio))
+        n_segments = int(self.media_seconds // self.segment_seconds)
+        delay = self.media_seconds / self.speed / max(n_segments, 1)
+
+        def segments():
+            for i in range(n_segments):
+                time.sleep(delay)
+                yield BenchSegment(i * self.segment_seconds, (i + 1) * self.segment_seconds - 0.1,
+                                   ' ' + ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 25))) + '.')
+        return segments(), BenchInfo(self.media_seconds)
+
+
+def copy_audio(video_fp, audio_fp):
+    # stands in for ffmpeg, which the stub model doesn't need
+    shutil.copyfile(video_fp, audio_fp)
+    return audio_fp
+
+
+def bench_end_to_end(n_videos, n_series=5, speed=float('inf'), media_seconds=600, segment_seconds=10,
+                     media_bytes=64 * 1024, download_workers=8, window_days=90):
+    """
+    Discovers, fetches, transcribes, renders and publishes n_videos from a local FakeIA, then reruns discovery
+    to time an incremental run. Returns the per stage report.
+    """
+    fake_ia = FakeIA(n_videos, n_series=n_series, media_bytes=media_bytes)
+    with tempfile.TemporaryDirectory() as tmp_dir, fake_ia_server(fake_ia) as session:
+        data_dir = Path(tmp_dir, 'data')
+        metrics = RunMetrics()
+        fetcher = IAVideoFetcher(preferred_formats=['h.264 ia'], start_date='2020-01-01', session=session,
+                                 max_connections=download_workers)
+        transcriber = Transcriber(BenchStubModel(media_seconds, segment_seconds, speed))
+        all_video_series = [VideoSeries(name, f'subject:({name})', data_dir=data_dir, keep_audio=True,
+                                        video_fetcher=fetcher, transcriber=transcriber, metrics=metrics)
+                            for name in fake_ia.series]
+        timings = {}
+
+        def timed(name, function, *args):
+            start = time.perf_counter()
+            result = function(*args)
+            timings[name] = time.perf_counter() - start
+            return result
+
+        discoveries = []
+
+        def discover():
+            discoveries.append(IASeriesDiscovery(session, fetcher.start_date, fake_ia.end_date,
+                                                 state_file=data_dir.joinpath('discovery_state.json'),
+                                                 window_days=window_days))
+            return asyncio.run(discoveries[-1].discover(all_video_series))
+
+        def update_identifiers(discovered):
+            for video_series in all_video_series:
+                video_series.update_identifiers(discovered[video_series.name])
+                discoveries[-1].commit(video_series)
+            return [video for video_series in all_video_series for video in video_series.pending_videos()]
+
+        discovered = timed('discover', discover)
+        pending_videos = timed('metadata', update_identifiers, discovered)
+        assert len(pending_videos) == n_videos
+        pipeline = VideoPipeline(download_workers=download_workers, audio_extractor=copy_audio,
+                                 extract_processes=False, report_interval=3600, metrics=metrics)
+        pipeline_report = timed('pipeline', pipeline.run, pending_videos)
+
+        repo_dir = Path(tmp_dir, 'md_repo')
+        repo_dir.mkdir()
+        subprocess.run(['git', 'init', '-q', str(repo_dir)], check=True)
+        subprocess.run(['git', '-C', str(repo_dir), 'config', 'user.email', 'bench@example.com'], check=True)
+        subprocess.run(['git', '-C', str(repo_dir), 'config', 'user.name', 'bench'], check=True)
+        publisher = MarkdownPublisher(data_dir.joinpath('markdown'), repo_dir,
+                                      state_file=data_dir.joinpath('publish_state.json'), metrics=metrics)
+        timed('publish', publisher.publish, 'Publish benchmark markdown')
+
+        rediscovered = timed('rediscover', discover)
+        assert not update_identifiers(rediscovered)
+
+        summary = metrics.summary()['stages']
+        rows = [[stage, stats['count'], round(stats['seconds'], 2), round(stats['count'] / stats['seconds'], 1)
+                 if stats['seconds'] else None, stats['realtime_factor']] for stage, stats in summary.items()]
+        print(f"\nend to end, {n_videos} videos in {n_series} series, {fake_ia.requests}")
+        print(tabulate(rows, headers=['stage', 'videos', 'busy s', 'videos/busy s', 'realtime factor']))
+        print(tabulate([[name, round(seconds, 2), round(n_videos / seconds, 1) if seconds else None]
+                        for name, seconds in timings.items()], headers=['phase', 'wall s', 'videos/s']))
+        print(tabulate([[stage, stats['elapsed_seconds'], stats['throughput_per_second'], stats['max_queue_depth']]
+                        for stage, stats in pipeline_report.items()],
+                       headers=['pipeline stage', 'elapsed s', 'videos/s', 'max queue']))
+        return {'timings': timings, 'stages': summary, 'pipeline': pipeline_report}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmarks.')
+    parser.add_argument('scenarios', nargs='*', type=int, default=[1, 100, 10000],
+                        help='numbers of videos for the end-to-end scenarios')
+    parser.add_argument('--speed', type=float, default=float('inf'), help='stub transcription speed, x realtime')
+    args = parser.parse_args()
+
+    bench_markdown_render()
+    bench_segment_scan()
+    for n_videos in args.scenarios:
+        bench_end_to_end(n_videos, speed=args.speed)
@@ -1,10 +1,27 @@
+import asyncio
+import hashlib
+import http.server
 import json
+import re
 import shutil
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import wave
+from collections import namedtuple
+from datetime import date
 from pathlib import Path
 
-from searchable_internet_archive_videos import VideoSeries, SearchableVideo, IAVideoFetcher, Transcriber, video2audio
+from searchable_internet_archive_videos import VideoSeries, SearchableVideo, IAVideoFetcher, Transcriber, video2audio, \
+    VideoPipeline, ItemMetadataStore, RunManifest, ShardedTranscriber, SegmentWriter, iter_segments, VideoDownloader, \
+    markdown_table_lines, chunk_write_md_file, SegmentSearchIndex, MarkdownPublisher, \
+    ColumnarSegmentStore, IASeriesDiscovery, SpeechDetector, TranscriptCache, RunMetrics, WorkScheduler, \
+    atomic_open, write_json_atomic, load_config, decode_pcm, main
 import pytest
-import ruamel.yaml as yaml
+from tabulate import tabulate
+import numpy as np
 
 from faster_whisper import WhisperModel
 from unittest.mock import Mock
@@ -12,6 +29,78 @@ import requests_cache
 
 requests_cache.install_cache('ia_test_cache', backend='sqlite', expire_after=60 * 60)
 
+FakeSegment = namedtuple('FakeSegment', ['start', 'end', 'text'])
+FakeInfo = namedtuple('FakeInfo', ['duration'])
+
+
+class FakeFetcher:
+    def __init__(self, identifiers):
+        self.identifiers = identifiers
+        self.downloads = []
+
+    def get_video_series_identifiers(self, video_series):
+        return self.identifiers
+
+    def get_video_file_name(self, identifier):
+        return f'{identifier}.mp4'
+
+    def get_file_size(self, identifier, file_name):
+        return len(b'fake video')
+
+    def get_video_metadata(self, identifier):
+        return f'https://archive.org/details/{identifier}', f'Title {identifier}', '2023-01-01'
+
+    def download_video_file(self, identifier, file_name, target_filepath):
+        self.downloads.append(identifier)
+        Path(target_filepath).write_bytes(b'fake video')
+        return target_filepath
+
+
+class StubWhisperModel:
+    """Deterministic stand in for WhisperModel that emits one segment every segment_length seconds."""
+    def __init__(self, duration=7.5, segment_length=2.5):
+        self.duration = duration
+        self.segment_length = segment_length
+        self.transcribed = []
+        self.options = []
+
+    def transcribe(self, audio, **options):
+        self.transcribed.append(audio)
+        self.options.append(options)
+        duration = len(audio) / 16000 if isinstance(audio, np.ndarray) else self.duration
+        starts = [i * self.segment_length for i in range(int(duration / self.segment_length))]
+        segments = (FakeSegment(start, start + self.segment_length, f' Segment at {start}') for start in starts)
+        return segments, FakeInfo(duration)
+
+
+def load_stub_model(duration):
+    return StubWhisperModel(duration=duration)
+
+
+class SlowStubWhisperModel(StubWhisperModel):
+    def transcribe(self, audio, **options):
+        segments, info = super().transcribe(audio, **options)
+        return (time.sleep(0.5) or segment for segment in segments), info
+
+
+def load_slow_stub_model(duration):
+    return SlowStubWhisperModel(duration=duration)
+
+
+def fake_video2audio(video_fp, audio_fp):
+    Path(audio_fp).write_bytes(Path(video_fp).read_bytes())
+    return audio_fp
+
+
+@pytest.fixture
+def fake_video_series(tmp_path):
+    fake_video_series = VideoSeries('Fake Series', 'identifier:(fake*)', data_dir=tmp_path, keep_audio=True,
+                                    video_fetcher=FakeFetcher(['fake1', 'fake2', 'fake3']),
+                                    transcriber=Transcriber(StubWhisperModel()))
+    fake_video_series.update_identifiers()
+    return fake_video_series
+
+
 @pytest.fixture()
 def clean_up_data_dir():
     shutil.rmtree('data', ignore_errors=True)
@@ -21,9 +110,7 @@ def clean_up_data_dir():
 
 @pytest.fixture
 def test_config():
-    with open('test_config.yaml', 'r') as f:
-        config = yaml.safe_load(f)
-    return config
+    return load_config('test_config.yaml')
 
 @pytest.fixture
 def test_transcriber(test_config):
@@ -111,4 +198,908 @@ def test_video_attribute(test_video_series, monkeypatch):
     mock_download_video_file.assert_not_called()
 
 
+@pytest.mark.parametrize('extract_processes', [True, False])
+def test_VideoPipeline_run(fake_video_series, extract_processes):
+    pipeline = VideoPipeline(download_workers=2, extract_workers=2, queue_size=1,
+                             audio_extractor=fake_video2audio, extract_processes=extract_processes)
+    report = pipeline.run(fake_video_series.videos.values())
+
+    for name in ('fake1', 'fake2', 'fake3'):
+        assert Path(fake_video_series.markdown_dir).joinpath(f'Title {name}_0.md').exists()
+    assert sorted(fake_video_series.video_fetcher.downloads) == ['fake1', 'fake2', 'fake3']
+    assert len(fake_video_series.transcriber.transcribing_model.transcribed) == 3
+    for stage in ('download', 'extract', 'transcribe', 'render'):
+        assert report[stage]['processed'] == 3
+        assert report[stage]['failed'] == 0
+        assert report[stage]['max_queue_depth'] <= 1
+
+
+def test_RunMetrics_report(fake_video_series, tmp_path):
+    metrics = RunMetrics()
+    VideoPipeline(audio_extractor=fake_video2audio, extract_processes=False, metrics=metrics).run(
+        fake_video_series.videos.values())
+    metrics.record('publish', 0.5, bytes_in=100, bytes_out=10)
+
+    report = json.loads(metrics.write_json(tmp_path / 'report.json', pipeline={'note': 'extra'}).read_text())
+    assert report['pipeline'] == {'note': 'extra'}
+    assert set(report['stages']) == {'download', 'extract', 'transcribe', 'render', 'publish'}
+    transcribe = report['series']['Fake Series']['transcribe']
+    assert transcribe['count'] == 3
+    assert transcribe['media_seconds'] == 3 * 7.5
+    assert transcribe['bytes_in'] == 3 * len(b'fake video')
+    assert transcribe['realtime_factor'] < 1
+    video = report['videos']['fake1']
+    assert video['media_seconds'] == 7.5
+    assert video['stages']['download']['bytes_out'] == len(b'fake video')
+    assert video['stages']['render']['bytes_in'] == Path(fake_video_series.videos['fake1']._segment_file).stat().st_size
+    assert report['stages']['publish']['realtime_factor'] is None
+
+    prometheus = metrics.write_prometheus(tmp_path / 'metrics.prom').read_text()
+    assert 'searchable_ia_videos_total{series="Fake Series",stage="transcribe"} 3' in prometheus
+    assert 'searchable_ia_stage_bytes_out_total{series="",stage="publish"} 10' in prometheus
+    assert '# TYPE searchable_ia_realtime_factor gauge' in prometheus
+
+
+def test_RunMetrics_times_decode_apart_from_transcription(fake_video_series, monkeypatch):
+    fake_video_series.keep_audio = False
+    monkeypatch.setattr('searchable_internet_archive_videos.video2pcm',
+                        lambda video_fp, offset=0.0: time.sleep(0.2) or np.zeros(10 * 16000, dtype=np.float32))
+    metrics = RunMetrics()
+    VideoPipeline(audio_extractor=fake_video2audio, extract_processes=False, metrics=metrics).run(
+        fake_video_series.videos.values())
+
+    stages = metrics.summary()['stages']
+    # streaming skips the extract stage, so the decode shows up as its own stage instead of inside transcribe
+    assert 'extract' not in stages
+    assert stages['decode']['count'] == 3
+    assert stages['decode']['seconds'] >= 3 * 0.2
+    assert stages['decode']['bytes_in'] == 3 * len(b'fake video')
+    assert stages['transcribe']['seconds'] < 3 * 0.2
+
+
+def test_import_defers_heavy_dependencies():
+    loaded = subprocess.run([sys.executable, '-c', 'import sys, searchable_internet_archive_videos; print(sorted('
+                             '{"faster_whisper", "internetarchive", "ffmpeg", "tabulate", "numpy", "requests"}'
+                             ' & set(sys.modules)))'],
+                            cwd=Path(__file__).resolve().parent.parent, check=True, capture_output=True, text=True)
+    assert loaded.stdout.strip() == '[]'
+
+
+def test_VideoSeries_from_json_restores_without_fetcher(fake_video_series, tmp_path):
+    VideoPipeline(audio_extractor=fake_video2audio, extract_processes=False).run(fake_video_series.videos.values())
+    video_series_json = json.loads(json.dumps(fake_video_series.to_dict()))
+    video_series_json['data_dir'] = str(tmp_path / 'restored')
+
+    restored = VideoSeries.from_json(video_series_json)
+    assert list(restored.videos) == ['fake1', 'fake2', 'fake3']
+    video = restored.videos['fake2']
+    assert (video.url, video.title, video.date) == ('https://archive.org/details/fake2', 'Title fake2', '2023-01-01')
+    assert video.to_dict() == fake_video_series.videos['fake2'].to_dict()
+    assert video.full_text == ' Segment at 0.0 Segment at 2.5 Segment at 5.0'
+    assert restored.manifest.get('fake2', 'metadata')['video_file_name'] == 'fake2.mp4'
+
+
+def test_main_status_and_render(tmp_path, monkeypatch, capsys):
+    import searchable_internet_archive_videos
+    monkeypatch.setattr(searchable_internet_archive_videos.logger, 'handlers', [])
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'config.yaml').write_text("meeting_video_series:\n"
+                                          "  - name: 'Fake Series'\n"
+                                          "    ia_search_query: 'identifier:(fake*)'\n"
+                                          "start_date: '2023-01-01'\n"
+                                          "preferred_formats: ['h.264']\n")
+    main(['status'])
+    assert capsys.readouterr().out.startswith('Fake Series: 0 videos, 0 video, 0 audio, 0 segment, 0 markdown')
+    assert not (tmp_path / 'data').exists()
+
+    video_series = VideoSeries('Fake Series', 'identifier:(fake*)', data_dir='data', keep_audio=True,
+                               video_fetcher=FakeFetcher(['fake1', 'fake2']),
+                               transcriber=Transcriber(StubWhisperModel()))
+    video_series.update_identifiers()
+    VideoPipeline(audio_extractor=fake_video2audio, extract_processes=False).run(
+        video_series.videos.values(), stages=['download', 'extract', 'transcribe'])
+    main(['status'])
+    assert '2 segment, 0 markdown, 2 pending' in capsys.readouterr().out
+
+    main(['render'])
+    main(['status'])
+    assert '2 segment, 2 markdown, 0 pending' in capsys.readouterr().out
+    assert len(list((tmp_path / 'data' / 'run_reports').glob('render_*.json'))) == 1
+
+    main(['search', "O'Connor stop-sign"])
+    assert capsys.readouterr().out == ''
+    main(['search', 'segment at-5'])
+    assert capsys.readouterr().out.count('?start=5') == 2
+    with pytest.raises(SystemExit):
+        main(['search', '--fts', 'stop-sign'])
+    assert 'invalid FTS5 query' in capsys.readouterr().err
+
+
+def test_VideoPipeline_skips_completed_stages(fake_video_series):
+    video = fake_video_series.videos['fake1']
+    Path(video._audio_file).write_bytes(b'fake audio')
+    report = VideoPipeline(audio_extractor=fake_video2audio, extract_processes=False).run([video])
+
+    assert fake_video_series.video_fetcher.downloads == []
+    assert report['download']['skipped'] == 1
+    assert report['extract']['skipped'] == 1
+    assert report['transcribe']['processed'] == 1
+
+
+def test_VideoPipeline_drops_failed_videos(fake_video_series):
+    def failing_video2audio(video_fp, audio_fp):
+        raise RuntimeError('ffmpeg failed')
+
+    report = VideoPipeline(audio_extractor=failing_video2audio, extract_processes=False).run(
+        fake_video_series.videos.values())
+
+    assert report['extract']['failed'] == 3
+    assert report['transcribe']['processed'] == 0
+    assert fake_video_series.transcriber.transcribing_model.transcribed == []
+
+
+def test_WorkScheduler_orders_newest_first_across_series(tmp_path):
+    dates = {'old': '2022-03-01', 'new': '2023-06-01', 'newest': '2023-07-01', 'undated': None}
+    videos = []
+    for name, identifiers in (('Council', ['old', 'newest']), ('Board', ['undated', 'new'])):
+        fetcher = FakeFetcher(identifiers)
+        fetcher.get_video_metadata = lambda identifier: (f'https://archive.org/details/{identifier}', identifier,
+                                                         dates[identifier])
+        video_series = VideoSeries(name, 'identifier:(fake*)', data_dir=tmp_path, video_fetcher=fetcher)
+        video_series.update_identifiers()
+        videos.extend(video_series.pending_videos())
+
+    assert [video.identifier for video in WorkScheduler().order(videos)] == ['newest', 'new', 'old', 'undated']
+    by_priority = WorkScheduler(order='priority', priorities={'Council': 1}).order(videos)
+    assert [video.identifier for video in by_priority] == ['newest', 'old', 'new', 'undated']
+
+
+def test_WorkScheduler_keeps_media_within_disk_budget(fake_video_series, monkeypatch):
+    fake_video_series.keep_audio = False
+    monkeypatch.setattr('searchable_internet_archive_videos.video2pcm',
+                        Mock(return_value=np.zeros(10 * 16000, dtype=np.float32)))
+    scheduler = WorkScheduler(disk_budget_bytes=len(b'fake video'))
+    report = VideoPipeline(download_workers=1, audio_extractor=fake_video2audio, extract_processes=False,
+                           scheduler=scheduler).run(fake_video_series.videos.values())
+
+    # each download waits for the video before it to be transcribed and deleted
+    assert report['render']['processed'] == 3
+    assert scheduler.peak_bytes == len(b'fake video')
+    assert scheduler.bytes_freed == 3 * len(b'fake video')
+    assert list(Path(fake_video_series.video_dir).iterdir()) == []
+
+    # media left behind by an earlier run is deleted once its segments exist
+    leftover = Path(fake_video_series.videos['fake1']._video_file)
+    leftover.write_bytes(b'fake video')
+    assert scheduler.release_completed(fake_video_series.videos.values()) == len(b'fake video')
+    assert not leftover.exists()
+
+
+def test_WorkScheduler_reserves_room_for_concurrent_downloads(fake_video_series, monkeypatch):
+    fake_video_series.keep_audio = False
+    monkeypatch.setattr('searchable_internet_archive_videos.video2pcm',
+                        Mock(return_value=np.zeros(10 * 16000, dtype=np.float32)))
+    scheduler = WorkScheduler(disk_budget_bytes=len(b'fake video'))
+    report = VideoPipeline(download_workers=4, audio_extractor=fake_video2audio, extract_processes=False,
+                           scheduler=scheduler).run(fake_video_series.videos.values())
+
+    assert report['render']['processed'] == 3
+    assert scheduler.peak_bytes == len(b'fake video')
+    assert scheduler.bytes_used == 0
+
+
+def test_WorkScheduler_drops_reservation_of_failed_download():
+    video = Mock(identifier='fake1')
+    video.video_series.name = 'Fake Series'
+    scheduler = WorkScheduler(disk_budget_bytes=100)
+    scheduler.admit(video, 60)
+    assert scheduler.bytes_used == 60
+    scheduler.finish(video)
+    assert scheduler.bytes_used == 0
+
+
+def test_WorkScheduler_waits_on_media_left_on_disk(fake_video_series, monkeypatch):
+    fake_video_series.keep_audio = False
+    monkeypatch.setattr('searchable_internet_archive_videos.video2pcm',
+                        Mock(return_value=np.zeros(10 * 16000, dtype=np.float32)))
+    new, old2, old1 = (fake_video_series.videos[identifier] for identifier in ('fake1', 'fake2', 'fake3'))
+    for video in (old2, old1):
+        Path(video._video_file).write_bytes(b'fake video')
+    scheduler = WorkScheduler(disk_budget_bytes=15)
+    scheduler.measure([fake_video_series])
+    report = VideoPipeline(download_workers=1, audio_extractor=fake_video2audio, extract_processes=False,
+                           scheduler=scheduler).run([new, old2, old1])
+
+    assert report['render']['processed'] == 3
+    assert fake_video_series.video_fetcher.downloads == ['fake1']
+    assert scheduler.peak_bytes == 20
+    assert list(Path(fake_video_series.video_dir).iterdir()) == []
+
+
+def test_WorkScheduler_leaves_videos_when_nothing_can_be_freed(fake_video_series):
+    Path(fake_video_series.video_dir).joinpath('unrelated.mp4').write_bytes(b'x' * 20)
+    scheduler = WorkScheduler(disk_budget_bytes=10)
+    scheduler.measure([fake_video_series])
+    report = VideoPipeline(audio_extractor=fake_video2audio, extract_processes=False,
+                           scheduler=scheduler).run(fake_video_series.videos.values())
+
+    assert report['download']['failed'] == 3
+    assert fake_video_series.video_fetcher.downloads == []
+
+
+def test_VideoPipeline_streams_audio_without_audio_file(fake_video_series, monkeypatch):
+    fake_video_series.keep_audio = False
+    video2pcm = Mock(return_value=np.zeros(10 * 16000, dtype=np.float32))
+    monkeypatch.setattr('searchable_internet_archive_videos.video2pcm', video2pcm)
+    video = fake_video_series.videos['fake1']
+    report = VideoPipeline(audio_extractor=fake_video2audio, extract_processes=False).run([video])
+
+    video2pcm.assert_called_once_with(video._video_file, offset=0)
+    assert isinstance(fake_video_series.transcriber.transcribing_model.transcribed[0], np.ndarray)
+    assert not Path(video._audio_file).exists()
+    assert report['extract']['skipped'] == 1
+    assert [segment['start'] for segment in iter_segments(video._segment_file)] == [0, 2, 5, 7]
+
+
+def test_RunManifest_rerun_needs_no_fetcher_or_glob(fake_video_series, tmp_path, monkeypatch):
+    VideoPipeline(audio_extractor=fake_video2audio, extract_processes=False).run(fake_video_series.videos.values())
+
+    fetcher = FakeFetcher(['fake1', 'fake2', 'fake3', 'fake4'])
+    rerun_series = VideoSeries('Fake Series', 'identifier:(fake*)', data_dir=tmp_path,
+                               video_fetcher=fetcher, transcriber=Transcriber(StubWhisperModel()))
+    fetcher.get_video_metadata = Mock(wraps=fetcher.get_video_metadata)
+    fetcher.get_video_file_name = Mock(wraps=fetcher.get_video_file_name)
+    monkeypatch.setattr('searchable_internet_archive_videos.glob.glob', Mock(side_effect=AssertionError))
+    rerun_series.update_identifiers()
+
+    assert [video.identifier for video in rerun_series.pending_videos()] == ['fake4']
+    fetcher.get_video_metadata.assert_called_once_with('fake4')
+    fetcher.get_video_file_name.assert_called_once_with('fake4')
+    segment_record = rerun_series.manifest.get('fake1', 'segment')
+    assert segment_record['files'][0]['path'] == rerun_series.videos['fake1']._segment_file
+    assert segment_record['files'][0]['size'] == Path(segment_record['files'][0]['path']).stat().st_size
+    segment_bytes = Path(segment_record['files'][0]['path']).read_bytes()
+    assert segment_record['files'][0]['md5'] == hashlib.md5(segment_bytes).hexdigest()
+    assert 'md5' not in rerun_series.manifest.get('fake1', 'video')['files'][0]
+
+
+def test_atomic_open_keeps_previous_file_on_error(tmp_path):
+    path = tmp_path / 'state' / 'state.json'
+    write_json_atomic(path, {'version': 1})
+    with pytest.raises(RuntimeError):
+        with atomic_open(path) as fp:
+            fp.write('{"version": ')
+            raise RuntimeError('killed mid-write')
+    assert json.loads(path.read_text()) == {'version': 1}
+    assert list(path.parent.iterdir()) == [path]
+
+
+def test_RunManifest_skips_truncated_line(tmp_path):
+    manifest = RunManifest(tmp_path / 'manifest.jsonl')
+    manifest.record('fake1', 'segment', files=[])
+    with open(tmp_path / 'manifest.jsonl', 'a') as fp:
+        fp.write('{"identifier": "fake2", "sta')
+
+    reloaded = RunManifest(tmp_path / 'manifest.jsonl')
+    assert reloaded.stage_complete('fake1', 'segment')
+    assert reloaded.identifiers() == ['fake1']
+
+    reloaded.record('fake3', 'segment', files=[])
+    assert RunManifest(tmp_path / 'manifest.jsonl').identifiers() == ['fake1', 'fake3']
+
+
+def test_Transcriber_transcribe_batch():
+    model = StubWhisperModel(duration=10.0, segment_length=5.0)
+    transcriber = Transcriber(model, beam_size=1, vad_filter=True, chunk_length=30, batch_size=4)
+    results = transcriber.transcribe_batch(['a.mp3', 'b.mp3'])
+
+    audio_fp, segments, info = next(results)
+    assert audio_fp == 'a.mp3'
+    assert model.transcribed == ['a.mp3']
+    assert [segment.start for segment in segments] == [0.0, 5.0]
+    assert [audio_fp for audio_fp, _, _ in results] == ['b.mp3']
+    assert model.options[0] == {'beam_size': 1, 'vad_filter': True, 'chunk_length': 30, 'batch_size': 4}
+    assert transcriber.audio_seconds == 20.0
+    assert transcriber.throughput > 0
+
+
+def test_Transcriber_batching_turns_on_vad_filter():
+    model = StubWhisperModel()
+    assert Transcriber(model).transcription_options()['vad_filter'] is False
+    list(Transcriber(model, batch_size=8).transcribe('a.mp3')[0])
+    assert model.options[0] == {'beam_size': 5, 'vad_filter': True, 'batch_size': 8}
+
+
+def test_ShardedTranscriber_streams_segments_as_they_are_transcribed(tmp_path):
+    write_silent_wav(tmp_path / 'a.wav', seconds=17.5)
+    transcriber = ShardedTranscriber(1, {'duration': 7.5}, model_factory=load_slow_stub_model)
+    try:
+        segments, info = transcriber.transcribe(str(tmp_path / 'a.wav'), offset=10.0)
+        first = next(segments)
+        first_received = time.monotonic()
+        assert info.duration is None
+        rest = list(segments)
+        finished = time.monotonic()
+    finally:
+        transcriber.close()
+
+    assert [segment.start for segment in [first] + rest] == [10.0, 12.5, 15.0]
+    # the two later segments took another 0.5s each in the worker
+    assert finished - first_received >= 0.9
+    assert info.duration == 7.5
+    assert transcriber.audio_seconds == 7.5
+
+
+def test_decode_pcm_seeks_to_offset(tmp_path):
+    audio = write_meeting_wav(tmp_path / 'meeting.wav')
+    decoded = decode_pcm(tmp_path / 'meeting.wav', offset=12.5)
+    assert len(decoded) == len(audio) - 12.5 * 16000
+    assert np.abs(decoded - audio[int(12.5 * 16000):]).max() < 1e-3
+
+
+def test_ShardedTranscriber_transcribe_batch():
+    transcriber = ShardedTranscriber(2, {'duration': 5.0}, {'beam_size': 1}, model_factory=load_stub_model)
+    try:
+        results = {audio_fp: segments for audio_fp, segments, info in
+                   transcriber.transcribe_batch([f'{i}.mp3' for i in range(4)])}
+        worker_report = transcriber.worker_report()
+    finally:
+        transcriber.close()
+
+    assert sorted(results) == ['0.mp3', '1.mp3', '2.mp3', '3.mp3']
+    assert [segment.start for segment in results['0.mp3']] == [0.0, 2.5]
+    assert sum(stats['files'] for stats in worker_report.values()) == 4
+    assert transcriber.audio_seconds == 20.0
+    assert all(stats['realtime_factor'] >= 0 for stats in worker_report.values())
+
+
+def write_silent_wav(path, seconds):
+    with wave.open(str(path), 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(16000)
+        wav.writeframes(b'\x00\x00' * int(seconds * 16000))
+
+
+def write_meeting_wav(path, speech=((10, 15), (30, 33), (33.5, 35)), seconds=40):
+    # a 440 Hz tone stands in for speech, everything else is dead air
+    t = np.arange(int(seconds * 16000)) / 16000
+    audio = np.zeros_like(t)
+    for start, end in speech:
+        speech_samples = slice(int(start * 16000), int(end * 16000))
+        audio[speech_samples] = 0.3 * np.sin(2 * np.pi * 440 * t[speech_samples])
+    with wave.open(str(path), 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(16000)
+        wav.writeframes((audio * 32767).astype('<i2').tobytes())
+    return audio.astype(np.float32)
+
+
+def test_SpeechDetector_regions(tmp_path):
+    audio = write_meeting_wav(tmp_path / 'meeting.wav')
+    regions = [(start / 16000, end / 16000) for start, end in SpeechDetector(padding_seconds=0.3).regions(audio)]
+    assert len(regions) == 2
+    assert regions[0] == pytest.approx((9.7, 15.3), abs=0.05)
+    assert regions[1] == pytest.approx((29.7, 35.3), abs=0.05)
+    assert SpeechDetector().regions(np.zeros(16000 * 5, dtype=np.float32)) == []
+
+
+@pytest.mark.parametrize('offset', [0.0, 20.0])
+def test_Transcriber_skips_silence_and_keeps_timestamps(tmp_path, offset):
+    write_meeting_wav(tmp_path / 'meeting.wav')
+    model = StubWhisperModel(segment_length=1.0)
+    transcriber = Transcriber(model, speech_detector=SpeechDetector(padding_seconds=0.3))
+    segments, info = transcriber.transcribe(str(tmp_path / 'meeting.wav'), offset=offset)
+    starts = [segment.start for segment in segments]
+
+    expected_regions = [(9.7, 15.3), (29.7, 35.3)] if not offset else [(29.7, 35.3)]
+    assert len(model.transcribed) == len(expected_regions)
+    assert starts[0] == pytest.approx(expected_regions[0][0], abs=0.05)
+    assert all(any(start - 0.05 <= s < end for start, end in expected_regions) for s in starts)
+    assert len(starts) == 5 * len(expected_regions)
+    assert info.duration == pytest.approx(40 - offset)
+    assert transcriber.skipped_fraction == pytest.approx(1 - 5.6 * len(expected_regions) / (40 - offset), abs=0.01)
+
+
+def test_SegmentWriter_resumes_from_checkpoint(tmp_path):
+    segment_file = tmp_path / 'segments.json'
+    writer = SegmentWriter(segment_file, fsync_every=10)
+    for start in range(25):
+        writer.write({'start': start, 'end': start + 1.0, 'text': f'{start}', 'url_with_time': f'url?start={start}'})
+    # simulate a crash: the last 5 segments were never checkpointed
+    writer._fp.close()
+
+    with SegmentWriter(segment_file, fsync_every=10) as writer:
+        assert writer.offset == 20.0
+        assert writer.segments_written == 20
+        writer.write({'start': 20, 'end': 21.0, 'text': '20', 'url_with_time': 'url?start=20'})
+
+    assert [segment['start'] for segment in iter_segments(segment_file)] == list(range(21))
+    with open(segment_file, 'r') as fp:
+        assert len(json.load(fp)) == 21
+    assert not writer.partial_file.exists()
+    assert not writer.checkpoint_file.exists()
+
+
+def test_iter_segments_reads_single_line_json(tmp_path):
+    with open(tmp_path / 'segments.json', 'w') as fp:
+        json.dump([{'start': 0, 'end': 1.0, 'text': 'a', 'url_with_time': 'url?start=0'}], fp)
+    assert [segment['text'] for segment in iter_segments(tmp_path / 'segments.json')] == ['a']
+
+
+def test_segment_file_resumes_interrupted_transcription(fake_video_series):
+    video = fake_video_series.videos['fake1']
+    write_silent_wav(video._audio_file, seconds=10)
+    writer = SegmentWriter(video._segment_file)
+    for start in (0, 2.5):
+        writer.write({'start': int(start), 'end': start + 2.5, 'text': f' Segment at {start}',
+                      'url_with_time': video.create_url_with_timestamp(int(start))})
+    writer.checkpoint()
+    writer._fp.close()
+
+    segments = list(iter_segments(video.segment_file))
+
+    model = fake_video_series.transcriber.transcribing_model
+    assert len(model.transcribed) == 1
+    assert len(model.transcribed[0]) == 5 * 16000
+    assert [segment['start'] for segment in segments] == [0, 2, 5, 7]
+    assert segments[2]['url_with_time'] == 'https://archive.org/details/fake1?start=5'
+
+
+def test_TranscriptCache_reuses_duplicate_audio(fake_video_series, tmp_path):
+    fake_video_series.transcript_cache = TranscriptCache(tmp_path / 'transcript_cache',
+                                                         model_params={'model_size': 'stub'})
+    write_meeting_wav(fake_video_series.videos['fake1']._audio_file)
+    write_meeting_wav(fake_video_series.videos['fake2']._audio_file)
+    write_meeting_wav(fake_video_series.videos['fake3']._audio_file, speech=((1, 4),))
+
+    segments = {identifier: list(iter_segments(video.segment_file))
+                for identifier, video in fake_video_series.videos.items()}
+
+    model = fake_video_series.transcriber.transcribing_model
+    assert len(model.transcribed) == 2
+    assert fake_video_series.transcript_cache.hits == 1
+    assert [(s['start'], s['end'], s['text']) for s in segments['fake2']] == \
+        [(s['start'], s['end'], s['text']) for s in segments['fake1']]
+    assert segments['fake2'][1]['url_with_time'] == 'https://archive.org/details/fake2?start=2'
+    assert fake_video_series.manifest.stage_complete('fake2', 'segment')
+
+    other_model = TranscriptCache(tmp_path / 'transcript_cache', model_params={'model_size': 'other'})
+    assert other_model.get(other_model.key(fake_video_series.videos['fake1']._audio_file)) is None
+
+
+def test_TranscriptCache_fingerprint_hashes_decoded_samples(tmp_path):
+    audio = write_meeting_wav(tmp_path / 'meeting.wav')
+    samples = (audio * 32767).astype('<i2').tobytes()
+    assert TranscriptCache.audio_fingerprint(tmp_path / 'meeting.wav') == hashlib.sha256(samples).hexdigest()
+
+
+def test_TranscriptCache_evicts_least_recently_used(tmp_path):
+    cache = TranscriptCache(tmp_path, max_bytes=400)
+    segments = [{'start': i, 'end': i + 1.0, 'text': ' padding text'} for i in range(3)]
+    for key in ('a', 'b', 'c'):
+        cache.put(key, segments)
+        time.sleep(0.01)
+        if key == 'b':
+            assert cache.get('a')['segments'] == segments
+            time.sleep(0.01)
+    assert len(cache) == 2
+    assert cache.get('b') is None
+    assert cache.get('a')['segments'] == segments
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    content = bytes(range(256)) * 1000
+    range_requests = []
+
+    def do_GET(self):
+        start = 0
+        if 'Range' in self.headers:
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            self.range_requests.append(start)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(self.content) - 1}/{len(self.content)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(self.content) - start))
+        self.end_headers()
+        self.wfile.write(self.content[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def range_server():
+    RangeRequestHandler.range_requests = []
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+
+
+def test_VideoDownloader_download_many(range_server, tmp_path):
+    content = RangeRequestHandler.content
+    downloader = VideoDownloader(max_connections=2)
+    targets = downloader.download_many([(f'{range_server}/{i}.mp4', tmp_path / f'{i}.mp4', len(content),
+                                         hashlib.md5(content).hexdigest()) for i in range(3)])
+
+    assert all(Path(target).read_bytes() == content for target in targets)
+    assert downloader.metrics()['bytes_downloaded'] == 3 * len(content)
+    assert downloader.bytes_per_second > 0
+
+
+def test_VideoDownloader_resumes_partial_file(range_server, tmp_path):
+    content = RangeRequestHandler.content
+    (tmp_path / 'video.mp4.part').write_bytes(content[:1000])
+    VideoDownloader().download(f'{range_server}/video.mp4', tmp_path / 'video.mp4', len(content))
+
+    assert RangeRequestHandler.range_requests == [1000]
+    assert (tmp_path / 'video.mp4').read_bytes() == content
+    assert not (tmp_path / 'video.mp4.part').exists()
+
+
+def test_VideoDownloader_rejects_bad_md5(range_server, tmp_path):
+    with pytest.raises(IOError):
+        VideoDownloader().download(f'{range_server}/video.mp4', tmp_path / 'video.mp4', expected_md5='0' * 32)
+    assert not (tmp_path / 'video.mp4').exists()
+    assert not (tmp_path / 'video.mp4.part').exists()
+
+
+def tabulate_markdown_lines(header_lines, rows):
+    md = '\n'.join(header_lines) + '\n' + tabulate(rows, tablefmt='github', headers=['Time', 'Transcript', 'Video'])
+    return SearchableVideo.remove_md_table_whitespace(md).splitlines()
+
+
+@pytest.mark.parametrize('texts', [
+    [' Hello there.', ' Second  segment ', ' a | b', ''],
+    [' 日本語の字幕', ' café', ' 42'],
+    [],
+])
+def test_markdown_table_lines_matches_tabulate(texts):
+    header_lines = ['## [Council | Meeting](https://archive.org/details/fake1)', '### 2023-01-01']
+    rows = [SearchableVideo.prettify_segment({'start': i * 3600, 'text': text,
+                                              'url_with_time': f'https://archive.org/details/fake1?start={i}'})
+            for i, text in enumerate(texts)]
+    md_header_lines, md_body_lines = markdown_table_lines(header_lines, rows)
+    assert md_header_lines + md_body_lines == tabulate_markdown_lines(header_lines, rows)
+
+
+@pytest.mark.parametrize('texts', [[' 1', ' 2.5', ' 1,000'], [' two\nlines']])
+def test_markdown_table_lines_defers_to_tabulate(texts):
+    rows = [SearchableVideo.prettify_segment({'start': 0, 'text': text, 'url_with_time': 'url'}) for text in texts]
+    assert markdown_table_lines(['## title', '### date'], rows) is None
+
+
+def test_chunk_write_md_file_rolls_over(tmp_path):
+    body_lines = [f'| 0:00:{i:02}| line {i}| [source video](url)|' for i in range(50)]
+    chunk_paths = chunk_write_md_file(tmp_path / 'video.md', 0, 'header\n', iter(body_lines), max_bytes=200)
+
+    chunks = [Path(chunk_path).read_text() for chunk_path in chunk_paths]
+    assert chunk_paths[1] == str(tmp_path / 'video_1.md')
+    assert all(chunk.startswith('header\n') for chunk in chunks)
+    assert ''.join(chunk[len('header\n'):] for chunk in chunks) == ''.join(line + '\n' for line in body_lines)
+    assert all(len(chunk.encode('utf-8')) - len(body_lines[0]) - 1 < 200 for chunk in chunks)
+
+
+def test_SegmentSearchIndex(fake_video_series, tmp_path):
+    VideoPipeline(audio_extractor=fake_video2audio, extract_processes=False).run(fake_video_series.videos.values())
+    index = SegmentSearchIndex(tmp_path / 'search_index.sqlite')
+    assert index.update(fake_video_series) == 3
+    assert index.update(fake_video_series) == 0
+
+    hits = index.search('"segment at 5"')
+    assert len(hits) == 3
+    assert all(hit.start == 5 for hit in hits)
+    assert hits[0].url_with_timestamp.endswith('?start=5')
+    assert len(index.search('segm*', limit=100)) == 9
+    assert len(index.search('segment', series='Fake Series', start_date='2023-01-01', end_date='2023-01-31')) == 9
+    assert index.search('segment', series='Other Series') == []
+    assert index.search('segment', end_date='2022-12-31') == []
+    for query in ('stop-sign', "O'Connor", 'city council.'):
+        with pytest.raises(sqlite3.OperationalError):
+            index.search(query)
+        assert index.search(query, plain=True) == []
+    assert len(index.search('Segment at-5', plain=True)) == 3
+    assert index.search('  ', plain=True) == []
+
+    segment_file = fake_video_series.videos['fake1']._segment_file
+    with open(segment_file, 'w') as fp:
+        json.dump([{'start': 0, 'end': 1.0, 'text': ' Rezoning hearing', 'url_with_time': 'url?start=0'}], fp)
+    assert index.update(fake_video_series) == 1
+    assert [hit.text for hit in index.search('rezon*')] == [' Rezoning hearing']
+    assert len(index.search('segment', limit=100)) == 6
+
+
+def test_SegmentSearchIndex_reads_from_columnar_store(fake_video_series, tmp_path, monkeypatch):
+    VideoPipeline(audio_extractor=fake_video2audio, extract_processes=False).run(fake_video_series.videos.values())
+    store = ColumnarSegmentStore(fake_video_series.columnar_dir)
+    store.sync(fake_video_series)
+    index = SegmentSearchIndex(tmp_path / 'search_index.sqlite')
+    with monkeypatch.context() as patched:
+        patched.setattr('searchable_internet_archive_videos.iter_segments', Mock(side_effect=AssertionError))
+        assert index.update(fake_video_series, store) == 3
+    hits = index.search('"segment at 5"')
+    assert len(hits) == 3
+    assert hits[0].url_with_timestamp.endswith('?start=5')
+
+    # a segment file rewritten since it was imported is read from its JSON again
+    with open(fake_video_series.videos['fake1']._segment_file, 'w') as fp:
+        json.dump([{'start': 0, 'end': 1.0, 'text': ' Rezoning hearing', 'url_with_time': 'url?start=0'}], fp)
+    assert not store.is_current('fake1', fake_video_series.videos['fake1']._segment_file)
+    assert index.update(fake_video_series, store) == 1
+    assert [hit.text for hit in index.search('rezon*')] == [' Rezoning hearing']
+
+
+def test_ColumnarSegmentStore_round_trips_json(fake_video_series, tmp_path):
+    VideoPipeline(audio_extractor=fake_video2audio, extract_processes=False).run(fake_video_series.videos.values())
+    store = ColumnarSegmentStore(fake_video_series.columnar_dir)
+    assert store.sync(fake_video_series) == 3
+    assert store.sync(fake_video_series) == 0
+    store.append_video('odd', 'https://archive.org/details/odd', [
+        {'start': 1.5, 'end': 2, 'text': ' caf\u00e9 \u2014 ok', 'url_with_time': 'https://example.com/clip'},
+        {'start': 2.5, 'end': 3, 'text': '', 'url_with_time': 'https://archive.org/details/odd?start=2'}])
+
+    reopened = ColumnarSegmentStore(fake_video_series.columnar_dir)
+    assert reopened.identifiers() == ['fake1', 'fake2', 'fake3', 'odd']
+    for identifier, video in fake_video_series.videos.items():
+        exported = tmp_path / f'{identifier}.json'
+        with open(exported, 'w') as fp:
+            reopened.export_json(identifier, fp)
+        with open(exported) as fp, open(video._segment_file) as expected:
+            assert json.load(fp) == json.load(expected)
+    assert [segment.to_dict() for segment in reopened.iter_segments('odd')] == [
+        {'start': 1.5, 'end': 2, 'text': ' caf\u00e9 \u2014 ok', 'url_with_time': 'https://example.com/clip'},
+        {'start': 2.5, 'end': 3, 'text': '', 'url_with_time': 'https://archive.org/details/odd?start=2'}]
+    assert len(list(reopened.scan())) == 11
+    with pytest.raises(ValueError):
+        reopened.append_video('odd', 'url', [])
+
+
+def test_ColumnarSegmentStore_reimports_rewritten_segment_file(fake_video_series):
+    VideoPipeline(audio_extractor=fake_video2audio, extract_processes=False).run(fake_video_series.videos.values())
+    store = ColumnarSegmentStore(fake_video_series.columnar_dir)
+    assert store.sync(fake_video_series) == 3
+    with open(fake_video_series.videos['fake1']._segment_file, 'w') as fp:
+        json.dump([{'start': 0, 'end': 1.0, 'text': ' Rezoning hearing', 'url_with_time': 'url?start=0'}], fp)
+
+    assert store.stale('fake1')
+    assert {identifier for identifier, _ in store.scan()} == {'fake2', 'fake3'}
+    assert store.sync(fake_video_series) == 1
+    assert store.sync(fake_video_series) == 0
+
+    reopened = ColumnarSegmentStore(fake_video_series.columnar_dir)
+    assert [segment.text for segment in reopened.iter_segments('fake1')] == [' Rezoning hearing']
+    assert len(list(reopened.scan())) == 7
+    assert reopened.index['dead'] == [[0, 3]]
+
+
+def test_ColumnarSegmentStore_drops_unindexed_rows(tmp_path):
+    store = ColumnarSegmentStore(tmp_path)
+    store.append_video('a', 'url', [{'start': 0, 'end': 1.0, 'text': ' one', 'url_with_time': 'url?start=0'}])
+    for path in [tmp_path / 'starts.d', tmp_path / 'ends.d', tmp_path / 'offsets.q', tmp_path / 'text.utf8']:
+        with open(path, 'ab') as f:
+            f.write(b'\0' * 8)
+    reopened = ColumnarSegmentStore(tmp_path)
+    assert [segment.text for segment in reopened.iter_segments('a')] == [' one']
+    assert (tmp_path / 'starts.d').stat().st_size == 8
+
+
+def git(*args, cwd):
+    return subprocess.run(['git', *args], cwd=cwd, check=True, capture_output=True, text=True).stdout
+
+
+def test_MarkdownPublisher_publishes_only_changes(tmp_path):
+    git('init', '--bare', 'remote.git', cwd=tmp_path)
+    git('clone', 'remote.git', 'repo', cwd=tmp_path)
+    repo = tmp_path / 'repo'
+    git('config', 'user.email', 'test@example.com', cwd=repo)
+    git('config', 'user.name', 'test', cwd=repo)
+    source = tmp_path / 'markdown'
+    for name in ('a', 'b', 'c'):
+        source.joinpath('Series').mkdir(parents=True, exist_ok=True)
+        source.joinpath('Series', f'{name}_0.md').write_text(f'# {name}\n')
+    publisher = MarkdownPublisher(source, repo, state_file=tmp_path / 'publish_state.json')
+
+    assert publisher.publish('first') == {'changed': 3, 'deleted': 0, 'unchanged': 0}
+    git('push', 'origin', 'HEAD', cwd=repo)
+    assert publisher.publish('nothing new') == {'changed': 0, 'deleted': 0, 'unchanged': 3}
+
+    source.joinpath('Series', 'a_0.md').write_text('# a, re-rendered\n')
+    source.joinpath('Series', 'b_0.md').unlink()
+    source.joinpath('Series', 'd_0.md').write_text('# d\n')
+    assert publisher.publish('second') == {'changed': 2, 'deleted': 1, 'unchanged': 1}
+    git('push', 'origin', 'HEAD', cwd=repo)
+
+    changed_paths = git('show', '--name-only', '--format=', 'HEAD', cwd=tmp_path / 'remote.git').split()
+    assert sorted(changed_paths) == ['meetings/Series/a_0.md', 'meetings/Series/b_0.md', 'meetings/Series/d_0.md']
+    assert git('log', '--format=%s', cwd=tmp_path / 'remote.git').split() == ['second', 'first']
+    assert repo.joinpath('meetings', 'Series', 'a_0.md').read_text() == '# a, re-rendered\n'
+
+    # c was removed from the repo by hand and d only from its working tree
+    git('rm', '-q', 'meetings/Series/c_0.md', cwd=repo)
+    git('commit', '-q', '-m', 'remove c', cwd=repo)
+    repo.joinpath('meetings', 'Series', 'd_0.md').unlink()
+    source.joinpath('Series', 'c_0.md').unlink()
+    source.joinpath('Series', 'd_0.md').unlink()
+    assert publisher.publish('third') == {'changed': 0, 'deleted': 1, 'unchanged': 1}
+    assert git('show', '--name-only', '--format=', 'HEAD', cwd=repo).split() == ['meetings/Series/d_0.md']
+
+
+def make_item_metadata(identifier):
+    return {'identifier': identifier, 'url': f'https://archive.org/details/{identifier}',
+            'download_url': f'https://archive.org/download/{identifier}', 'title': f'Title {identifier}',
+            'date': '2023-01-01', 'files': [{'name': f'{identifier}.mp4', 'format': 'h.264', 'size': '10'}]}
+
+
+def test_ItemMetadataStore_persists(tmp_path):
+    ItemMetadataStore(tmp_path / 'metadata.sqlite').put(make_item_metadata('fake1'))
+    metadata = ItemMetadataStore(tmp_path / 'metadata.sqlite').get('fake1')
+    assert metadata['title'] == 'Title fake1'
+    assert metadata['files'][0]['name'] == 'fake1.mp4'
+
+
+def test_ItemMetadataStore_eviction(tmp_path, monkeypatch):
+    store = ItemMetadataStore(tmp_path / 'metadata.sqlite', ttl_seconds=60, max_entries=2)
+    for identifier in ('fake1', 'fake2', 'fake3'):
+        store.put(make_item_metadata(identifier))
+    assert len(store) == 2
+    assert store.get('fake1') is None
+
+    later = time.time() + 120
+    monkeypatch.setattr('searchable_internet_archive_videos.time.time', lambda: later)
+    assert store.get('fake3') is None
+
+
+@pytest.fixture
+def mock_ia_session(monkeypatch):
+    monkeypatch.setenv('IA_USERNAME', 'user')
+    monkeypatch.setenv('IA_PASSWORD', 'password')
+    monkeypatch.setattr('internetarchive.configure', Mock())
+    session = Mock()
+    session.get_item.return_value.urls.details = 'https://archive.org/details/fake1'
+    session.get_item.return_value.urls.download = 'https://archive.org/download/fake1'
+    session.get_item.return_value.metadata = {'title': 'Title fake1', 'date': '2023-01-01'}
+    session.get_item.return_value.files = [{'name': 'fake1.mp4', 'format': 'h.264', 'size': '10', 'mtime': '1'}]
+    monkeypatch.setattr('internetarchive.get_session', lambda: session)
+    return session
+
+
+def test_IAVideoFetcher_fetches_item_once(mock_ia_session):
+    fetcher = IAVideoFetcher()
+    assert fetcher.get_video_file_name('fake1') == 'fake1.mp4'
+    assert fetcher.get_video_metadata('fake1') == ('https://archive.org/details/fake1', 'Title fake1', '2023-01-01')
+    mock_ia_session.get_item.assert_called_once_with('fake1')
+
+
+def test_IAVideoFetcher_select_media_file(mock_ia_session):
+    files = [{'name': 'big.mp4', 'format': 'h.264', 'size': '3000'},
+             {'name': 'small.mp4', 'format': 'h.264 IA', 'size': '2000'},
+             {'name': 'thumb.jpg', 'format': 'Thumbnail', 'size': '10'},
+             {'name': 'audio.ogg', 'format': 'Ogg Vorbis', 'size': '500'},
+             {'name': 'audio.mp3', 'format': 'VBR MP3', 'size': '400'}]
+    fetcher = IAVideoFetcher(preferred_formats=['h.264 ia', 'h.264'])
+    assert fetcher.select_media_file(files)['name'] == 'small.mp4'
+
+    fetcher = IAVideoFetcher(preferred_formats=['h.264 ia', 'h.264'], audio_formats=['VBR MP3', 'Ogg Vorbis'])
+    assert fetcher.select_media_file(files)['name'] == 'audio.mp3'
+    assert fetcher.select_media_file(files[2:3]) is None
+
+
+class FakeSearchBackend:
+    def __init__(self, items):
+        self.items = items
+        self.queries = []
+        self.threads = set()
+
+    def search_items(self, query, fields=None):
+        self.queries.append(query)
+        self.threads.add(threading.get_ident())
+        time.sleep(0.01)
+        if 'Broken' in query:
+            raise ConnectionError('search failed')
+        subject = re.search(r'subject:\((\w+)\)', query).group(1)
+        low, high = re.search(r'AND date:\[(\S+) TO (\S+)\]', query).groups()
+        added = re.search(r'addeddate:\[(\S+) TO', query)
+        return [{field: item[field] for field in fields} for item in self.items
+                if item['subject'] == subject and low <= item['date'][:10] <= high
+                and (not added or item['addeddate'][:10] >= added.group(1))]
+
+
+def test_IASeriesDiscovery_shards_and_resumes_from_high_water_mark(tmp_path):
+    items = [{'identifier': f'{subject}-{month}', 'subject': subject, 'date': f'2023-{month:02d}-15T00:00:00Z',
+              'addeddate': f'2023-{month:02d}-16 10:00:00'} for subject in ('Council', 'Beer') for month in range(1, 7)]
+    backend = FakeSearchBackend(items)
+    all_video_series = [VideoSeries(name, f'subject:({name})', data_dir=tmp_path) for name in ('Council', 'Beer')]
+    all_video_series.append(VideoSeries('Broken', 'subject:(Broken)', data_dir=tmp_path))
+    discovery = IASeriesDiscovery(backend, date(2023, 1, 1), date(2023, 6, 30), state_file=tmp_path / 'state.json',
+                                  window_days=30)
+
+    discovered = asyncio.run(discovery.discover(all_video_series))
+    assert discovered == {'Council': [f'Council-{month}' for month in range(1, 7)],
+                          'Beer': [f'Beer-{month}' for month in range(1, 7)], 'Broken': []}
+    assert len(backend.queries) == 3 * 7
+    assert len(backend.threads) > 1
+    assert not (tmp_path / 'state.json').exists()
+    for video_series in all_video_series:
+        discovery.commit(video_series)
+    assert json.loads((tmp_path / 'state.json').read_text())['Council'] == {'date': '2023-06-15',
+                                                                            'addeddate': '2023-06-16'}
+
+    items.append({'identifier': 'Council-late', 'subject': 'Council', 'date': '2023-02-01T00:00:00Z',
+                  'addeddate': '2023-06-20 09:00:00'})
+    backend.queries.clear()
+    discovery = IASeriesDiscovery(backend, date(2023, 1, 1), date(2023, 6, 30), state_file=tmp_path / 'state.json',
+                                  window_days=30)
+    discovered = asyncio.run(discovery.discover(all_video_series))
+    assert discovered['Council'] == ['Council-6', 'Council-late']
+    assert discovered['Beer'] == ['Beer-6']
+    assert sum('Broken' not in query for query in backend.queries) == 2
+    assert discovery.new_marks['Council']['addeddate'] == '2023-06-20'
+    assert 'Broken' not in discovery.new_marks
+
+
+def test_IASeriesDiscovery_keeps_mark_until_identifiers_are_recorded(tmp_path):
+    items = [{'identifier': f'Council-{month}', 'subject': 'Council', 'date': f'2023-{month:02d}-15T00:00:00Z',
+              'addeddate': f'2023-{month:02d}-16 10:00:00'} for month in range(1, 7)]
+    fetcher = FakeFetcher([])
+    get_video_metadata = fetcher.get_video_metadata
+
+    def flaky_metadata(identifier):
+        if identifier == 'Council-3':
+            raise ConnectionError('metadata failed')
+        return get_video_metadata(identifier)
+    fetcher.get_video_metadata = flaky_metadata
+    video_series = VideoSeries('Council', 'subject:(Council)', data_dir=tmp_path, video_fetcher=fetcher)
+
+    def discover_and_record():
+        discovery = IASeriesDiscovery(FakeSearchBackend(items), date(2023, 1, 1), date(2023, 6, 30),
+                                      state_file=tmp_path / 'state.json', window_days=30)
+        discovered = asyncio.run(discovery.discover([video_series]))
+        video_series.update_identifiers(discovered['Council'])
+        discovery.commit(video_series)
+
+    with pytest.raises(ConnectionError):
+        discover_and_record()
+    assert not (tmp_path / 'state.json').exists()
+
+    fetcher.get_video_metadata = get_video_metadata
+    discover_and_record()
+    assert sorted(video_series.videos) == [f'Council-{month}' for month in range(1, 7)]
+    assert json.loads((tmp_path / 'state.json').read_text())['Council']['addeddate'] == '2023-06-16'
+
+
+def test_update_identifiers_keeps_manifest_identifiers(fake_video_series, tmp_path):
+    rerun_series = VideoSeries('Fake Series', 'identifier:(fake*)', data_dir=tmp_path,
+                               video_fetcher=FakeFetcher([]), transcriber=Transcriber(StubWhisperModel()))
+    rerun_series.update_identifiers(['fake4'])
+    assert list(rerun_series.videos) == ['fake1', 'fake2', 'fake3', 'fake4']
+
+
+def test_benchmark_end_to_end_runs_offline(monkeypatch):
+    import benchmarks
+    monkeypatch.delenv('IA_USERNAME', raising=False)
+    monkeypatch.delenv('IA_PASSWORD', raising=False)
+    report = benchmarks.bench_end_to_end(6, n_series=2, media_bytes=4096)
+    assert {stage: stats['count'] for stage, stats in report['stages'].items()} == {
+        'metadata': 6, 'download': 6, 'extract': 6, 'transcribe': 6, 'render': 6, 'publish': 1}
+
+
+def test_VideoPipeline_audio_only_download(fake_video_series, monkeypatch):
+    monkeypatch.setattr(fake_video_series.video_fetcher, 'get_video_file_name', lambda identifier: f'{identifier}.mp3')
+    video = SearchableVideo('fake4', fake_video_series)
+    extractor = Mock()
+    report = VideoPipeline(audio_extractor=extractor, extract_processes=False).run([video])
+
+    extractor.assert_not_called()
+    assert video.audio_only
+    assert video._audio_file.endswith('Title fake4.mp3')
+    assert Path(video._audio_file).exists()
+    assert not Path(video._video_file).exists()
+    assert report['extract']['skipped'] == 1
+    assert report['render']['processed'] == 1
+
+
 #TODO: add test for missing file types